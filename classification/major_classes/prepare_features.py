@@ -46,11 +46,11 @@ label_map = {d['old_label']: d['label'] for d in labels}
 # get idxs which have datapoints for major classes
 db = DBConnector('dbs/master')
 db.open()
-labels = db.get_all_targets('train')
+keys, labels = db.get_keys_and_targets('train')
 db.close()
 
 keep = [d in major_labels for d in labels]
-keep_idxs = [i for i, d in enumerate(keep) if d]
+keep_idxs = [k for k, d in zip(keys, keep) if d]
 sum(keep) / len(keep)  # 0.96
 
 
@@ -67,11 +67,12 @@ db_major.clear_db()
 
 db_master.open()
 db_major.open()
-for idx, part in zip(keep_idxs, parts):
-    key = db_major.get_next_key(part)
-    imgs, labels_old = db_master.get_values([idx], 'train')
-    label_new = label_map[labels_old[0]]
-    db_major.write_data(key, (imgs[0], label_new), part)
+with db_major.writer('train') as train, db_major.writer('val') as val:
+    writers = dict(train=train, val=val)
+    for idx, part in zip(keep_idxs, parts):
+        imgs, labels_old = db_master.get_values([idx], 'train')
+        label_new = label_map[labels_old[0]]
+        writers[part].write((imgs[0], label_new))
 db_master.close()
 db_major.close()
 
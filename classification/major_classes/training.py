@@ -22,8 +22,8 @@ num_epochs = 1000
 patience = 200
 n_classes = 8
 db = 'dbs/major_classes'
-ds_val = BeeDataset(db, 'val', [trans.resize, trans.totensor])
-ds_train = BeeDataset(db, 'train', [trans.augment, trans.totensor])
+ds_val = BeeDataset(db, 'val', [trans.resize, trans.totensor], lazy=True)
+ds_train = BeeDataset(db, 'train', [trans.augment, trans.totensor], lazy=True)
 
 
 # Hyperparameter Space
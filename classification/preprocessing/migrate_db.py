@@ -0,0 +1,40 @@
+"""Migrate DBs
+
+Rewrite keys of the old format (`chr(int)` as UTF-8) as 8 byte big-endian ints
+and records of the old format (pickled PIL image and label) as raw
+records (see `utils/dbconnector.py`). Images are resized to 150x150 px
+on the way, as they would be when written now.
+Then the label index of each sub-DB is rebuilt. Sub-DBs which don't exist
+are skipped, a dry run opens the DBs read-only.
+
+    python -m preprocessing.migrate_db dbs/master dbs/major_classes
+"""
+import argparse
+from utils.dbconnector import DBConnector
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rewrite old keys and pickled records")
+    parser.add_argument("dbs", nargs="+", help="paths of LMDBs")
+    parser.add_argument("--subdbs", nargs="+", default=["train", "val", "test"], help="sub-DBs to migrate")
+    parser.add_argument("--batch-size", type=int, default=1000, help="records per write transaction")
+    parser.add_argument("--dry-run", action="store_true", help="only count old keys and records")
+    args = parser.parse_args()
+
+    for path in args.dbs:
+        db = DBConnector(path)
+        db.open(readonly=args.dry_run)
+        for subdb in args.subdbs:
+            if not db.has_db(subdb):
+                print("%s %s: no such sub-DB, skipped" % (path, subdb))
+                continue
+            if args.dry_run:
+                n_keys, n = db.count_legacy_keys(subdb), db.count_legacy(subdb)
+                indexed = db.get_label_index(subdb) is not None
+            else:
+                n_keys = db.rekey(subdb, batch_size=args.batch_size)
+                n = db.migrate(subdb, batch_size=args.batch_size)
+                db.build_index(subdb)
+                indexed = True
+            print("%s %s: %d old keys, %d old records, label index: %s" % (path, subdb, n_keys, n, indexed))
+        db.close()
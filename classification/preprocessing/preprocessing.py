@@ -3,6 +3,8 @@
 According to `label_maps.json` images are loaded from various subdirs under `data/`
 and inserted into a LMDB (`dbs/master/`) as `test` and `train` sub-DBs.
 Train-test split is 2-1.
+Images are stored resized to 150x150 px as raw pixel buffers (see `utils/dbconnector.py`).
+DBs written with the old pickled format can be converted with `preprocessing/migrate_db.py`.
 
 Then transformations for resizsing and data augmentation are tried out.
 To visually check them, samples are plotted as raw, resized and several augmentations.
@@ -37,14 +39,15 @@ db = DBConnector("dbs/master")
 db.clear_db()
 
 db.open()
-for label_map in label_maps:
-    print("label", label_map["label"])
-    for subdir in label_map["subdirs"]:
-        paths, parts = partition_samples(subdir)
-        for path, part in zip(paths, parts):
-            key = db.get_next_key(part)
-            img = Image.open(path)
-            db.write_data(key, (img, label_map["label"]), part)
+with db.writer("train") as train, db.writer("test") as test:
+    writers = dict(train=train, test=test)
+    for label_map in label_maps:
+        print("label", label_map["label"])
+        for subdir in label_map["subdirs"]:
+            paths, parts = partition_samples(subdir)
+            for path, part in zip(paths, parts):
+                img = Image.open(path)
+                writers[part].write((img, label_map["label"]))
 db.close()
 
 
@@ -106,7 +109,7 @@ for sample in subset:
     feats, targets = db.get_values([sample], "train")
     idx = [d["label"] for d in label_maps].index(targets[0])
     plot_augmented_data(
-        feats[0],
+        Image.fromarray(feats[0]),
         title=label_maps[idx]["name"],
         save=os.path.join(
             "preprocessing",
@@ -1,26 +1,70 @@
-from torch.utils.data import Dataset
+import os
+from PIL import Image
+from torch.utils.data import Dataset, get_worker_info
 from torchvision.transforms import Compose
 from utils.dbconnector import DBConnector
 
+# read-only lmdbs of this process shared by lazy datasets
+# (lmdb opens a path only once per process, environments inherited
+# through fork must not be used)
+_readers = {}
+_readers_pid = None
+
+
+def get_reader(db_uri):
+    """Read-only DBConnector for db_uri, opened once per process"""
+    global _readers_pid
+    if _readers_pid != os.getpid():
+        for db in _readers.values():
+            db.close()
+        _readers.clear()
+        _readers_pid = os.getpid()
+    if db_uri not in _readers:
+        db = DBConnector(db_uri)
+        db.open(readonly=True)
+        _readers[db_uri] = db
+    return _readers[db_uri]
+
 
 class BeeDataset(Dataset):
-    def __init__(self, db_uri, subdb, transforms):
+    def __init__(self, db_uri, subdb, transforms, lazy=False):
         """
         db_uri: connection str for lmdb
         subdb: 'train' or 'val'
         transforms: list of transformations for imgs before returning
+        lazy: bl whether to only load keys and labels up front and read imgs
+              on demand (from a read-only lmdb per process, DataLoader workers
+              can open it in BeeDataset.worker_init_fn)
         """
-        db = DBConnector(db_uri)
+        self.db_uri = db_uri
+        self.subdb = subdb
+        self.lazy = lazy
         self.transform = Compose(transforms)
-        db.open()
-        self.imgs = db.get_all_features(subdb)
-        self.labels = db.get_all_targets(subdb)
-        db.close()
+        if lazy:
+            self.keys, self.labels = get_reader(db_uri).get_keys_and_targets(subdb)
+        else:
+            db = DBConnector(db_uri)
+            db.open()
+            self.imgs = db.get_all_features(subdb)
+            self.labels = db.get_all_targets(subdb)
+            db.close()
 
     def __len__(self):
         return len(self.labels)
 
     def __getitem__(self, idx):
-        x = self.transform(self.imgs[idx])
+        if self.lazy:
+            imgs, _ = get_reader(self.db_uri).get_values([self.keys[idx]], self.subdb)
+            img = imgs[0]
+        else:
+            img = self.imgs[idx]
+        x = self.transform(Image.fromarray(img))
         y = self.labels[idx]
         return x, y
+
+    @staticmethod
+    def worker_init_fn(worker_id):
+        """Open lmdb in DataLoader worker (lazy datasets)"""
+        ds = get_worker_info().dataset
+        if getattr(ds, "lazy", False):
+            get_reader(ds.db_uri)
@@ -1,21 +1,119 @@
 import shutil
 import pickle
+import struct
 import lmdb
+import numpy as np
+from PIL import Image
+
+# Records are a fixed header followed by the raw pixel buffer (uint8, HWC).
+# Header: magic, format version, numpy dtype char, height, width, channels, label
+MAGIC = b"BEE\x00"
+VERSION = 1
+HEADER = struct.Struct("<4sBc2xIIIq")
+# Keys are unsigned 64 bit ints, big-endian so byte order is numeric order
+KEY = struct.Struct(">Q")
+# Sub-DB with label index: marker b"labels:<dataset>" and chunks
+# b"labels:<dataset>:<first key>" of up to INDEX_CHUNK int64 labels of
+# consecutive keys
+META = "meta"
+INDEX_CHUNK = 1000
+
+
+def encode_record(img, label, size=None):
+    """Encode image and label as raw record
+    img: PIL image or np image (HW or HWC)
+    label: int target
+    size: (height, width) to resize to before encoding (None keeps size),
+          resizing is bilinear like torchvision.transforms.Resize
+    """
+    if not isinstance(img, Image.Image) and size is not None:
+        img = Image.fromarray(np.asarray(img, dtype=np.uint8))
+    if isinstance(img, Image.Image):
+        img = img.convert("RGB")
+        if size is not None and img.size != (size[1], size[0]):
+            img = img.resize((size[1], size[0]), Image.BILINEAR)
+    arr = np.asarray(img, dtype=np.uint8)
+    if arr.ndim == 2:
+        arr = arr[:, :, None]
+    arr = np.ascontiguousarray(arr)
+    header = HEADER.pack(MAGIC, VERSION, arr.dtype.char.encode(), *arr.shape, int(label))
+    return header + arr.tobytes()
+
+
+def is_legacy(buf):
+    """Whether record is a pickled (PIL image, label) tuple"""
+    return bytes(buf[: len(MAGIC)]) != MAGIC
+
+
+def decode_label(buf):
+    """Get label of record without decoding the image"""
+    if is_legacy(buf):
+        return pickle.loads(buf)[1]
+    return HEADER.unpack_from(buf)[6]
+
+
+def decode_record(buf):
+    """Decode record into (np image HWC, label)
+    Raw records are decoded zero-copy, the image is a read-only view on `buf`,
+    so with a buffer from a transaction (buffers=True) it is only valid
+    within that transaction. Legacy records are unpickled and converted.
+    """
+    if is_legacy(buf):
+        img, label = pickle.loads(buf)
+        return np.asarray(img.convert("RGB")), label
+    _, version, dtype, h, w, c, label = HEADER.unpack_from(buf)
+    if version > VERSION:
+        raise ValueError("Record format version %d is not supported" % version)
+    arr = np.frombuffer(buf, dtype=np.dtype(dtype.decode()), count=h * w * c, offset=HEADER.size)
+    return arr.reshape(h, w, c), label
 
 
 class DBConnector(object):
+    """LMDB of images and labels in sub-DBs
+    Images are stored as raw records (see encode_record()), pre-resized
+    to `size`. Records of the old format (pickled PIL image and label) are
+    still read and can be rewritten with migrate().
+    Labels are also kept in an index (meta sub-DB), updated in the same
+    transaction as the records, so targets are read without a scan.
+    Sub-DBs written before the index existed need build_index().
+    db_name: path of lmdb
+    size: (height, width) images are resized to when written (None keeps size)
+    """
 
     map_size = int(4e9)  # 4GB
-    max_dbs = 3  # train, val, test
+    max_dbs = 4  # train, val, test, meta
 
-    def __init__(self, db_name):
+    def __init__(self, db_name, size=(150, 150)):
         self.db_name = db_name
+        self.size = size
 
-    def open(self):
-        self.db = lmdb.open(self.db_name, max_dbs=self.max_dbs, map_size=self.map_size)
+    def open(self, readonly=False):
+        """Open environment
+        readonly: open read-only without lock file and readahead, e.g. for
+                  random reads in DataLoader workers (open it in each process)
+        """
+        if readonly:
+            self.db = lmdb.open(
+                self.db_name, max_dbs=self.max_dbs, readonly=True, lock=False, readahead=False
+            )
+        else:
+            self.db = lmdb.open(self.db_name, max_dbs=self.max_dbs, map_size=self.map_size)
+        self._sub_dbs = {}
 
     def close(self):
         self.db.close()
+        self._sub_dbs = {}
+
+    def _get_db(self, dataset):
+        """Sub-DB handle, opened once per environment"""
+        if dataset not in self._sub_dbs:
+            self._sub_dbs[dataset] = self.db.open_db(dataset.encode(), create=not self.db.flags()["readonly"])
+        return self._sub_dbs[dataset]
+
+    def has_db(self, dataset):
+        """Whether the sub-DB exists, without creating it"""
+        with self.db.begin() as txn:
+            return txn.get(dataset.encode()) is not None
 
     def clear_db(self):
         try:
@@ -25,48 +123,80 @@ class DBConnector(object):
 
     def write_data(self, key, value, dataset):
         """Write value into db as (features, target), use int key"""
-        sub_db = self.db.open_db(dataset.encode())
+        sub_db = self._get_db(dataset)
+        self._get_db(META)
         with self.db.begin(write=True) as txn:
+            indexed = self._has_index(txn, dataset)
             cur = txn.cursor(sub_db)
-            cur.put(DBConnector._int2key(key), pickle.dumps(value))
+            cur.put(DBConnector._int2key(key), encode_record(*value, size=self.size))
+            if indexed:
+                self._index_put(txn, dataset, int(key), [value[1]])
+
+    def writer(self, dataset, batch_size=1000):
+        """Bulk writer for a sub-DB, use as context manager (see BulkWriter)"""
+        return BulkWriter(self, dataset, batch_size)
+
+    def write_many(self, values, dataset, batch_size=1000):
+        """Write iterable of (features, target) under the next free keys
+        returns list of int keys
+        """
+        with self.writer(dataset, batch_size) as writer:
+            return [writer.write(value) for value in values]
 
     def get_values(self, key_list, dataset):
-        """Get records by int keys as tuple of (features, targets)"""
-        sub_db = self.db.open_db(dataset.encode())
-        with self.db.begin() as txn:
+        """Get records by int keys as tuple of (features, targets)
+        features are uint8 np images (HWC)
+        """
+        sub_db = self._get_db(dataset)
+        with self.db.begin(buffers=True) as txn:
             cur = txn.cursor(sub_db)
             targets = []
             feats = []
             for key in key_list:
-                value = pickle.loads(cur.get(DBConnector._int2key(key)))
-                feats.append(value[0])
-                targets.append(value[1])
+                img, label = decode_record(cur.get(DBConnector._int2key(key)))
+                feats.append(np.array(img))
+                targets.append(label)
         return feats, targets
 
     def get_all_targets(self, dataset):
-        """Iterate over all db entries to get list of targets"""
-        sub_db = self.db.open_db(dataset.encode())
+        """Get list of targets from label index (iterate over all db entries
+        if there is none)"""
+        return self.get_keys_and_targets(dataset)[1]
+
+    def get_keys_and_targets(self, dataset):
+        """Get int keys and targets from label index (iterate over all db
+        entries if there is none)"""
+        index = self.get_label_index(dataset)
+        if index is not None:
+            return index[0].tolist(), index[1].tolist()
+        return self._scan_keys_and_targets(dataset)
+
+    def _scan_keys_and_targets(self, dataset):
+        """Iterate over all db entries to get int keys and targets"""
+        sub_db = self._get_db(dataset)
+        keys = []
         targets = []
-        with self.db.begin() as txn:
+        with self.db.begin(buffers=True) as txn:
             cur = txn.cursor(sub_db)
             cur.first()
             for k, v in cur:
-                targets.append(pickle.loads(v)[1])
-        return targets
+                keys.append(DBConnector._key2int(bytes(k)))
+                targets.append(decode_label(v))
+        return keys, targets
 
     def get_all_features(self, dataset):
         """Iterate over all db entries to get list of features"""
-        sub_db = self.db.open_db(dataset.encode())
-        with self.db.begin() as txn:
+        sub_db = self._get_db(dataset)
+        with self.db.begin(buffers=True) as txn:
             cur = txn.cursor(sub_db)
             cur.first()
             feats = []
             for k, v in cur:
-                feats.append(pickle.loads(v)[0])
+                feats.append(np.array(decode_record(v)[0]))
         return feats
 
     def get_next_key(self, dataset):
-        sub_db = self.db.open_db(dataset.encode())
+        sub_db = self._get_db(dataset)
         with self.db.begin() as txn:
             cur = txn.cursor(sub_db)
             if cur.last():
@@ -74,10 +204,221 @@ class DBConnector(object):
             else:
                 return 0
 
+    def get_label_index(self, dataset):
+        """Get label index as (keys, labels) int64 np arrays ordered by key,
+        None if the sub-DB has no index"""
+        try:
+            meta = self._get_db(META)
+        except lmdb.NotFoundError:
+            return None
+        marker = DBConnector._index_prefix(dataset)
+        keys = []
+        labels = []
+        with self.db.begin() as txn:
+            if txn.get(marker, db=meta) is None:
+                return None
+            cur = txn.cursor(meta)
+            prefix = marker + b":"
+            more = cur.set_range(prefix)
+            while more and cur.key().startswith(prefix):
+                first = KEY.unpack(cur.key()[len(prefix) :])[0]
+                chunk = np.frombuffer(cur.value(), dtype=np.int64)
+                keys.append(np.arange(first, first + len(chunk), dtype=np.int64))
+                labels.append(chunk)
+                more = cur.next()
+        if len(labels) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(keys), np.concatenate(labels)
+
+    def build_index(self, dataset):
+        """(Re)build label index of a sub-DB from its records"""
+        keys, targets = self._scan_keys_and_targets(dataset)
+        meta = self._get_db(META)
+        marker = DBConnector._index_prefix(dataset)
+        prefix = marker + b":"
+        with self.db.begin(write=True) as txn:
+            cur = txn.cursor(meta)
+            more = cur.set_range(prefix)
+            while more and cur.key().startswith(prefix):
+                more = cur.delete()
+            txn.put(marker, b"", db=meta)
+            # chunks of consecutive keys
+            i = 0
+            while i < len(keys):
+                j = i + 1
+                while j < len(keys) and j - i < INDEX_CHUNK and keys[j] == keys[j - 1] + 1:
+                    j += 1
+                txn.put(
+                    prefix + KEY.pack(keys[i]), np.array(targets[i:j], dtype=np.int64).tobytes(), db=meta
+                )
+                i = j
+
+    def _has_index(self, txn, dataset):
+        """Whether labels of sub-DB are indexed, call before writing records
+        An index is started for empty sub-DBs."""
+        meta = self._get_db(META)
+        marker = DBConnector._index_prefix(dataset)
+        if txn.get(marker, db=meta) is not None:
+            return True
+        if txn.stat(self._get_db(dataset))["entries"] == 0:
+            txn.put(marker, b"", db=meta)
+            return True
+        return False
+
+    def _index_put(self, txn, dataset, first, labels):
+        """Set labels of keys first, first + 1, ... in label index
+        Updates the chunks containing those keys and extends the chunk ending
+        at `first`, new chunks are started where a chunk would exceed
+        INDEX_CHUNK labels or run into the next chunk."""
+        meta = self._get_db(META)
+        prefix = DBConnector._index_prefix(dataset) + b":"
+        labels = np.asarray(labels, dtype=np.int64)
+        cur = txn.cursor(meta)
+        while len(labels) > 0:
+            # chunk starting at or before first
+            key, start, chunk = prefix + KEY.pack(first), first, np.zeros(0, dtype=np.int64)
+            found = cur.set_range(key)
+            if not (found and cur.key() == key):
+                found = cur.prev() if found else cur.last()
+            if found and cur.key().startswith(prefix):
+                s = KEY.unpack(cur.key()[len(prefix) :])[0]
+                c = np.frombuffer(cur.value(), dtype=np.int64)
+                if first < s + len(c) or (first == s + len(c) and len(c) < INDEX_CHUNK):
+                    key, start, chunk = cur.key(), s, c
+            # up to INDEX_CHUNK labels and the start of the next chunk
+            stop = start + max(len(chunk), INDEX_CHUNK)
+            if cur.set_range(prefix + KEY.pack(first + 1)) and cur.key().startswith(prefix):
+                stop = min(stop, KEY.unpack(cur.key()[len(prefix) :])[0])
+            n = min(len(labels), stop - first)
+            merged = np.zeros(max(start + len(chunk), first + n) - start, dtype=np.int64)
+            merged[: len(chunk)] = chunk
+            merged[first - start : first - start + n] = labels[:n]
+            txn.put(key, merged.tobytes(), db=meta)
+            first, labels = first + n, labels[n:]
+
+    def count_legacy(self, dataset):
+        """Count records of the old (pickled) format"""
+        sub_db = self._get_db(dataset)
+        with self.db.begin(buffers=True) as txn:
+            cur = txn.cursor(sub_db)
+            cur.first()
+            return sum(is_legacy(v) for _, v in cur)
+
+    def migrate(self, dataset, batch_size=1000):
+        """Rewrite records of the old (pickled) format as raw records
+        Records are rewritten in place in transactions of `batch_size` records.
+        returns number of rewritten records
+        """
+        sub_db = self._get_db(dataset)
+        n = 0
+        last = None
+        while True:
+            batch = []
+            with self.db.begin() as txn:
+                cur = txn.cursor(sub_db)
+                more = cur.first() if last is None else cur.set_range(last)
+                if more and last is not None and cur.key() == last:
+                    more = cur.next()
+                while more and len(batch) < batch_size:
+                    last = cur.key()
+                    if is_legacy(cur.value()):
+                        batch.append((last, encode_record(*pickle.loads(cur.value()), size=self.size)))
+                    more = cur.next()
+            if len(batch) > 0:
+                with self.db.begin(write=True) as txn:
+                    txn.cursor(sub_db).putmulti(batch)
+                n += len(batch)
+            if not more:
+                return n
+
+    def count_legacy_keys(self, dataset):
+        """Count keys of the old format (chr(int) as UTF-8)"""
+        sub_db = self._get_db(dataset)
+        with self.db.begin() as txn:
+            cur = txn.cursor(sub_db)
+            return sum(len(k) != KEY.size for k in cur.iternext(values=False))
+
+    def rekey(self, dataset, batch_size=1000):
+        """Rewrite keys of the old format (chr(int) as UTF-8) as 8 byte keys
+        The int keys stay the same. Records are moved in transactions of
+        `batch_size` records.
+        returns number of rewritten keys
+        """
+        sub_db = self._get_db(dataset)
+        with self.db.begin() as txn:
+            cur = txn.cursor(sub_db)
+            old_keys = [k for k in cur.iternext(values=False) if len(k) != KEY.size]
+        for i in range(0, len(old_keys), batch_size):
+            with self.db.begin(write=True) as txn:
+                for key in old_keys[i : i + batch_size]:
+                    value = txn.get(key, db=sub_db)
+                    txn.delete(key, db=sub_db)
+                    txn.put(DBConnector._int2key(ord(key.decode())), value, db=sub_db)
+        return len(old_keys)
+
+    @staticmethod
+    def _index_prefix(dataset):
+        return b"labels:" + dataset.encode()
+
     @staticmethod
     def _int2key(num):
-        return chr(int(num)).encode()
+        return KEY.pack(int(num))
 
     @staticmethod
     def _key2int(key):
-        return ord(key.decode())
+        if len(key) != KEY.size:
+            raise ValueError("Key of old format, rewrite keys with preprocessing/migrate_db.py")
+        return KEY.unpack(key)[0]
+
+
+class BulkWriter(object):
+    """Appends records to a sub-DB in batched write transactions
+    Keys are assigned sequentially starting at the next free key. Encoded
+    records are buffered and committed every `batch_size` records and when
+    the context is left, so several writers (e.g. one per sub-DB) can be
+    used at the same time.
+
+        with db.writer("train") as writer:
+            key = writer.write((img, label))
+    """
+
+    def __init__(self, connector, dataset, batch_size=1000):
+        self.connector = connector
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.next_key = connector.get_next_key(dataset)
+        self.batch = []
+        self.labels = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def write(self, value):
+        """Add (features, target), returns its int key"""
+        key = self.next_key
+        self.batch.append((DBConnector._int2key(key), encode_record(*value, size=self.connector.size)))
+        self.labels.append(value[1])
+        self.next_key += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        return key
+
+    def flush(self):
+        """Commit buffered records"""
+        if len(self.batch) == 0:
+            return
+        sub_db = self.connector._get_db(self.dataset)
+        self.connector._get_db(META)
+        with self.connector.db.begin(write=True) as txn:
+            indexed = self.connector._has_index(txn, self.dataset)
+            _, added = txn.cursor(sub_db).putmulti(self.batch, overwrite=False, append=True)
+            if added != len(self.batch):
+                raise ValueError("Keys are not after the last key of %s (keys of old format?)" % self.dataset)
+            if indexed:
+                first = DBConnector._key2int(self.batch[0][0])
+                self.connector._index_put(txn, self.dataset, first, self.labels)
+        self.batch = []
+        self.labels = []
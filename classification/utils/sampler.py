@@ -4,6 +4,7 @@ Sampler Factories for passing into utils.train.train_with_params()
 They need to be callable with a list of labels
 from which they are supposed to sample.
 """
+import numpy as np
 from torch.utils.data.sampler import WeightedRandomSampler
 
 
@@ -12,14 +13,8 @@ class EqualDistribution(object):
         self.replacement = replacement
 
     def __call__(self, labels):
-        unique_labels = list(set(labels))
-        n_per_label = [labels.count(d) for d in unique_labels]
-        N = sum(n_per_label)
-        w_per_label = [N / d for d in n_per_label]
-        weights = []
-        for label in labels:
-            i = unique_labels.index(label)
-            weights.append(w_per_label[i])
+        _, idxs, n_per_label = np.unique(labels, return_inverse=True, return_counts=True)
+        weights = len(labels) / n_per_label[idxs]
         return WeightedRandomSampler(
-            weights, len(weights), replacement=self.replacement
+            weights.tolist(), len(weights), replacement=self.replacement
         )
@@ -30,6 +30,7 @@ def train_with_params(
 ):
     """
     ds_train: torch Dataset instance for training data
+              (its worker_init_fn is passed to the DataLoader if it has one)
     ds_val: torch Dataset instance for validation data
     model: torch.nn model instance
     patience: int how many epochs before early stopping
@@ -57,6 +58,7 @@ def train_with_params(
                 batch_size=batch_size,
                 shuffle=False,
                 num_workers=workers,
+                worker_init_fn=getattr(ds_train, "worker_init_fn", None),
                 sampler=sampler_train,
             ),
             val=DataLoader(
@@ -64,16 +66,25 @@ def train_with_params(
                 batch_size=batch_size,
                 shuffle=False,
                 num_workers=workers,
+                worker_init_fn=getattr(ds_val, "worker_init_fn", None),
                 sampler=sampler_val,
             ),
         )
     else:
         dataloaders = dict(
             train=DataLoader(
-                ds_train, batch_size=batch_size, shuffle=True, num_workers=workers
+                ds_train,
+                batch_size=batch_size,
+                shuffle=True,
+                num_workers=workers,
+                worker_init_fn=getattr(ds_train, "worker_init_fn", None),
             ),
             val=DataLoader(
-                ds_val, batch_size=batch_size, shuffle=True, num_workers=workers
+                ds_val,
+                batch_size=batch_size,
+                shuffle=True,
+                num_workers=workers,
+                worker_init_fn=getattr(ds_val, "worker_init_fn", None),
             ),
         )
 
@@ -3,7 +3,8 @@ import plotly.express as px
 
 
 methods = ['simple_thresholding', 'local_thresholding', 'simple_gradient',
-           'double_gradient', 'refine_segmentation', 'refine_segmentation2']
+           'double_gradient', 'refine_segmentation', 'refine_segmentation2',
+           'refine_lattice']
 
 results = []
 for method in methods:
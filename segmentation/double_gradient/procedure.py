@@ -1,111 +1,102 @@
-import copy
-import warnings
 import numpy as np
-import utils.image as image
-from utils.segmentation import Segment, Segmentation, segment_overlap
-from skimage import segmentation, measure, exposure, color
-from skimage.filters import threshold_otsu, rank, gaussian
-from skimage.morphology import disk, skeletonize
-
-
-def region2segment(region, img, expand=1.2):
-    '''Get segment from region based on convex hull
-    region: region from regionprops()
-    img: image from which region was extracted
+from utils.segmentation import Segmentation
+from utils.preprocessing import get_preprocessor
+from skimage import segmentation, measure
+from skimage.filters import threshold_otsu
+from skimage.morphology import skeletonize
+
+# version of get_labels, part of its cache key, bump it when get_labels changes
+LABELS_VERSION = 1
+
+
+def regions2segmentation(labels, img=None, expand=1.2):
+    '''Get segments from all labeled regions at once
+    Bounding boxes are expanded around the centroid of each region. The
+    centroid of the region's pixels is used as approximation for the
+    centroid of its convex hull.
+    labels: int label image
+    img: image from which regions were extracted
     expand: factor by which to expand the bounding box
     '''
-    minr, minc, maxr, maxc = region.bbox
-    chull = image.mask_image(img[minr:maxr, minc:maxc], region.convex_image)
-    cent = image.centroid(chull)
-    cent = (cent[0] + minr, cent[1] + minc)
-    s = Segment(
-        centroid=cent,
-        dx_r=int((maxc - cent[1]) * expand),
-        dx_l=int((cent[1] - minc) * expand),
-        dy_u=int((cent[0] - minr) * expand),
-        dy_d=int((maxr - cent[0]) * expand))
-    return s
-
-
-def segment_fits(s, max_ar=1.5, area_range=(1000, 100000), diam_range=(150, 500)):
-    '''Does segment fit into defined space?
-    max_ar: maximum aspect ratio allowed
-    area_range: min and max area allowed
-    diam_range: min and max diam allwoed
-    '''
-    return s.ar_max < max_ar and \
-        s.area > area_range[0] and \
-        s.area < area_range[1] and \
-        min([s.xdiam, s.ydiam]) > diam_range[0] and \
-        max([s.xdiam, s.ydiam]) < diam_range[1]
+    regions = Segmentation.from_labels(labels)
+    rows, cols = np.nonzero(labels)
+    idxs = labels[rows, cols] - 1
+    counts = np.bincount(idxs)
+    used = counts > 0
+    crow = (np.bincount(idxs, rows)[used] / counts[used]).astype(int)
+    ccol = (np.bincount(idxs, cols)[used] / counts[used]).astype(int)
+
+    minc, maxc, minr, maxr = regions.ranges.T
+    ranges = np.stack([
+        ccol - np.trunc((ccol - minc) * expand),
+        ccol + np.trunc((maxc - ccol) * expand),
+        crow - np.trunc((crow - minr) * expand),
+        crow + np.trunc((maxr - crow) * expand)], axis=1)
+    return Segmentation(ranges, img=img)
 
 
 def remove_duplicates(seg, overlap=0.7):
     '''Consolidate segments which overlap a lot. The largest segment is chosen.
     overlap: min relative overlap that defines whether 2 segments are consolidated
     '''
-    segment_grps = []
-    unused_segments = copy.deepcopy(seg)
-    for s1 in seg:
-        if s1.name not in unused_segments.names:
+    D = seg.get_sparse_overlap_matrix()
+    areas = seg.areas
+    rmvd = np.zeros(len(seg), dtype=bool)
+    keep = []
+    for i in range(len(seg)):
+        if rmvd[i]:
             continue
-        unused_segments.remove(s1)
-        similars = [s2 for s2 in unused_segments if segment_overlap(s1, s2) > overlap]
-        segment_grps.append([s1] + similars)
-        for sim in similars:
-            unused_segments.remove(sim)
-
-    seg_cons = Segmentation(seg.img)
-    for grp in segment_grps:
-        max_area = max([d.area for d in grp])
-        seg_cons.add([d for d in grp if d.area == max_area][0])
-    return seg_cons
+        row = slice(D.indptr[i], D.indptr[i + 1])
+        idxs = D.indices[row][D.data[row] > overlap]
+        idxs = idxs[~rmvd[idxs]]
+        rmvd[idxs] = True
+        # zero-area segments have no overlap with themselves (NaN)
+        if len(idxs) == 0:
+            rmvd[i] = True
+            keep.append(i)
+            continue
+        keep.append(idxs[np.argmax(areas[idxs])])
+    return seg[np.array(keep, dtype=int)]
 
 
-def generate_segmentation(img, denoise_mask=3, gradient_mask=3):
-    '''Create Segmentation object from color np image
-    denoise_mask: mask used for denoising image in the beginning
-    gradient_mask: mask used for computing gradient
+def get_labels(pre, denoise_mask, gradient_mask):
+    '''label image of skeletonized gradient at 2 thresholds
+    pre: utils.preprocessing.Preprocessor of image
+    other parameters as in generate_segmentation
     '''
-    # gray scale
-    gray = color.rgb2gray(img)
-
-    # denoise
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        denoised = gaussian(rank.median(gray, disk(denoise_mask)), denoise_mask)
-
-    # contrast stretching for normalization
-    p2, p98 = np.percentile(denoised, (2, 98))
-    normed = exposure.rescale_intensity(denoised, in_range=(p2, p98))
-
-    # image gradient
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        grad = rank.gradient(normed, disk(gradient_mask))
+    # denoise, contrast stretching for normalization and image gradient
+    grad = pre.gradient(gradient_mask, median=denoise_mask, sigma=denoise_mask)
 
     # thresholding
     thr_h = threshold_otsu(grad)
     thr_l = threshold_otsu(grad[grad < thr_h])
 
-    markers_h = np.zeros(grad.shape, dtype=float)
-    markers_h[grad > thr_h] = 1
-
-    markers_l = np.zeros(grad.shape, dtype=float)
-    markers_l[(grad < thr_h) & (grad > thr_l)] = 1
+    markers_h = grad > thr_h
+    markers_l = (grad < thr_h) & (grad > thr_l)
 
-    markers = skeletonize(markers_h) + skeletonize(markers_l)
+    markers = skeletonize(markers_h) | skeletonize(markers_l)
 
     # labels
     cleared = segmentation.clear_border(markers)
     labels = measure.label(cleared)
+    return labels
+
+
+def generate_segmentation(img, denoise_mask=3, gradient_mask=3):
+    '''Create Segmentation object from color np image
+    img: color np image or utils.preprocessing.Preprocessor of it
+    denoise_mask: mask used for denoising image in the beginning
+    gradient_mask: mask used for computing gradient
+    '''
+    pre = get_preprocessor(img)
+
+    labels = pre.cached(
+        ("double_gradient.labels", LABELS_VERSION, denoise_mask, gradient_mask),
+        lambda: get_labels(pre, denoise_mask, gradient_mask))
 
     # capture labeled regions in rectangles
-    seg = Segmentation(img)
-    for region in measure.regionprops(labels):
-        s = region2segment(region, labels)
-        if segment_fits(s):
-            seg.add(s)
+    seg = regions2segmentation(labels, img=pre.img)
+    seg = seg[seg.fits(diam_range=(150, 500), area_range=(1000, 100000), max_ar=1.5)]
 
     # remove multi-captured segments
     seg_filtered = remove_duplicates(seg)
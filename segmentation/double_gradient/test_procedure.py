@@ -3,19 +3,22 @@ import numpy as np
 import utils.plot as plot
 from skimage import io, color
 from utils.evaluation import Validation
+from utils.cache import ArrayCache
+from utils.preprocessing import Preprocessor
 from double_gradient.procedure import generate_segmentation
 
 
 image_names = ['angled', 'capped', 'dark', 'egg', 'empty', 'medium', 'small']
 data_dir = 'data/broodmapper/'
 base_dir = 'double_gradient/'
+cache = ArrayCache('data/cache/')  # intermediates shared across runs
 
 
 # load original images and do segmentation
 images = dict()
 for image_name in image_names:
     img = io.imread(data_dir + image_name + '.jpg')
-    seg = generate_segmentation(img)
+    seg = generate_segmentation(Preprocessor(img, cache=cache))
     images[image_name] = dict(img=img, seg=seg)
 
 
@@ -26,13 +29,13 @@ for image_name in images:
     val.confuse(images[image_name]['seg'])
     images[image_name]['val'] = val
     print(image_name, val)
-# angled <Validation TPR 0.96 PPV 0.93/>
-# capped <Validation TPR 0.60 PPV 0.89/>
-# dark <Validation TPR 0.62 PPV 0.86/>
-# egg <Validation TPR 0.99 PPV 0.95/>
-# empty <Validation TPR 1.00 PPV 0.93/>
-# medium <Validation TPR 0.96 PPV 0.95/>
-# small <Validation TPR 0.99 PPV 0.83/>
+# angled <Validation TPR 0.77 PPV 0.75/>
+# capped <Validation TPR 0.54 PPV 0.80/>
+# dark <Validation TPR 0.60 PPV 0.83/>
+# egg <Validation TPR 0.97 PPV 0.93/>
+# empty <Validation TPR 0.97 PPV 0.90/>
+# medium <Validation TPR 0.94 PPV 0.94/>
+# small <Validation TPR 0.95 PPV 0.79/>
 
 
 # see segmentations
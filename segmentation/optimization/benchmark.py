@@ -0,0 +1,153 @@
+import argparse
+import os
+import numpy as np
+from functools import lru_cache
+from skimage import io
+from utils.benchmark import Case, run, compare, format_table, write_results, read_results
+from utils.evaluation import Validation
+from utils.segmentation import Segmentation, consolidate_segments
+from utils.vector import VectorCollection, consolidate_vectors
+from utils.angles import predict_expected_angles
+import simple_thresholding.procedure as simple_thresholding
+import local_thresholding.procedure as local_thresholding
+import simple_gradient.procedure as simple_gradient
+import double_gradient.procedure as double_gradient
+import refine_segmentation.procedure as refine_segmentation
+import refine_segmentation2.procedure as refine_segmentation2
+import refine_lattice.procedure as refine_lattice
+
+image_names = ['angled', 'capped', 'dark', 'egg', 'empty', 'medium', 'small']
+data_dir = 'data/broodmapper/'
+base_dir = 'optimization/'
+baseline_path = base_dir + 'results_benchmark.json'
+sizes = [1000, 5000, 20000]
+
+
+def generate_lattice(n, d=100, diam=90, drop=0.1, noise=3, n_preds=1, seed=0):
+    '''Segmentation of a hexagonal lattice of about n cells with spacing d
+    Cells are dropped with probability `drop`, the others are predicted
+    `n_preds` times with some gaussian noise. The image is a zero-size stand-in
+    with the shape of the comb.
+    '''
+    rng = np.random.default_rng(seed)
+    side = int(np.sqrt(n))
+    rows, cols = np.meshgrid(np.arange(side), np.arange(side), indexing='ij')
+    x = (cols + (rows % 2) / 2) * d + d
+    y = rows * d * np.sqrt(3) / 2 + d
+    xy = np.stack([x.ravel(), y.ravel()], axis=1)
+    xy = xy[rng.uniform(size=len(xy)) > drop]
+    xy = np.repeat(xy, n_preds, axis=0) + rng.normal(scale=noise, size=(len(xy) * n_preds, 2))
+    xy = rng.permutation(xy)
+    pad = diam / 2
+    img = np.broadcast_to(np.uint8(0), (int(y.max()) + 2 * d, int(x.max()) + 2 * d))
+    return Segmentation(
+        np.stack([xy[:, 0] - pad, xy[:, 0] + pad, xy[:, 1] - pad, xy[:, 1] + pad], axis=1),
+        img=img)
+
+
+@lru_cache(maxsize=None)
+def load_image(name):
+    return io.imread(data_dir + name + '.jpg')
+
+
+@lru_cache(maxsize=None)
+def initial_segmentation(name):
+    return simple_gradient.generate_segmentation(load_image(name))
+
+
+def copy(seg):
+    return Segmentation(seg.ranges.copy(), img=seg.img)
+
+
+def lattice_cases(n):
+    seg = generate_lattice(n)
+    preds = generate_lattice(n, drop=0, n_preds=3)
+    vectors = VectorCollection.from_array(preds.centroids[:, ::-1])
+
+    def predict_new_vectors():
+        v = VectorCollection.from_array(seg.centroids[:, ::-1])
+        d_mean, d_std = refine_segmentation.get_neighbour_distances(v.get_nearest_distances())
+        kernel = (d_mean + d_std) * 10
+        neighbours = v.get_neighbours(kernel)
+        _, _, D, A = neighbours
+        angles, angle_std = predict_expected_angles(
+            refine_segmentation.get_neighbour_angles(A, D, d_mean + 2 * d_std))
+        return lambda: refine_segmentation.predict_new_vectors(
+            neighbours=neighbours, vectors=v, angles=angles, angles_std=2 * angle_std,
+            max_distance=d_mean + d_std, mean_distance=d_mean, kernel=kernel)
+
+    cases = [
+        Case('consolidate_segments/%d' % n, lambda: lambda: consolidate_segments(preds, 0.5)),
+        Case('get_sparse_overlap_matrix/%d' % n, lambda: preds.get_sparse_overlap_matrix),
+        Case('consolidate_vectors/%d' % n, lambda: lambda: consolidate_vectors(vectors, 50)),
+        Case('predict_new_vectors/%d' % n, predict_new_vectors),
+        Case('refine_segmentation/%d' % n,
+             lambda: lambda: refine_segmentation.generate_segmentation(copy(seg), n=2)),
+        Case('refine_segmentation2/%d' % n,
+             lambda: lambda: refine_segmentation2.generate_segmentation(copy(seg))),
+        Case('refine_lattice/%d' % n,
+             lambda: lambda: refine_lattice.generate_segmentation(copy(seg))),
+    ]
+    # dense matrix needs len(preds)^2 memory
+    if len(preds) <= 5000:
+        cases.append(Case('get_overlap_matrix/%d' % n, lambda: preds.get_overlap_matrix))
+    return cases
+
+
+def broodmapper_cases():
+    '''each case runs on all broodmapper images'''
+
+    def procedure(module):
+        def setup():
+            images = [load_image(name) for name in image_names]
+            return lambda: [module.generate_segmentation(img) for img in images]
+        return setup
+
+    def refinement(module):
+        def setup():
+            segs = [copy(initial_segmentation(name)) for name in image_names]
+            return lambda: [module.generate_segmentation(seg) for seg in segs]
+        return setup
+
+    def confuse():
+        vals = [
+            (Validation(load_image(name), data_dir + name + '_labels.png'), initial_segmentation(name))
+            for name in image_names]
+        return lambda: [val.confuse(seg) for val, seg in vals]
+
+    cases = [
+        Case('broodmapper/%s' % m.__name__.split('.')[0], procedure(m), repeat=1)
+        for m in [simple_thresholding, local_thresholding, simple_gradient, double_gradient]]
+    cases += [
+        Case('broodmapper/%s' % m.__name__.split('.')[0], refinement(m))
+        for m in [refine_segmentation, refine_segmentation2, refine_lattice]]
+    cases.append(Case('broodmapper/Validation.confuse', confuse))
+    return cases
+
+
+def get_cases():
+    cases = [case for n in sizes for case in lattice_cases(n)]
+    return cases + broodmapper_cases()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run benchmarks and compare them to the baseline')
+    parser.add_argument('select', nargs='*', help='only run cases containing one of these')
+    parser.add_argument('--update', action='store_true', help='write results as new baseline')
+    parser.add_argument('--no-memory', action='store_true', help='do not measure peak memory')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown tolerated')
+    args = parser.parse_args()
+
+    baseline = read_results(baseline_path) if os.path.isfile(baseline_path) else []
+    recs = []
+    for rec in run(get_cases(), memory=not args.no_memory, select=args.select):
+        recs.append(compare([rec], baseline, args.tolerance)[0])
+        print(format_table(recs[-1:]).split('\n')[1], flush=True)
+    print(format_table(recs))
+
+    if args.update:
+        # keep baseline of cases which were not run
+        names = {d['name'] for d in recs}
+        write_results([d for d in baseline if d['name'] not in names] + recs, baseline_path)
+    if any(d['regression'] for d in recs):
+        raise SystemExit(1)
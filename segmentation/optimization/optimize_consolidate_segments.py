@@ -1,6 +1,7 @@
 import time
 import numpy as np
 from utils.segmentation import Segmentation, Segment
+from utils.segmentation import consolidate_segments as sparse_consolidate_segments
 
 
 def generate_segmentation(n):
@@ -45,3 +46,10 @@ print('%d -> %d: %.2fs' % (len(seg), len(res), time.time() - t0))
 # 5000 -> 1337: 6.23s using xrange/yrange only
 # 5000 -> 1528: 4.84s using get_overlap_matrix
 # 5000 -> 1503: 4.82s few small changes
+
+
+# sparse overlap matrix (only intersecting pairs via KD-tree)
+t0 = time.time()
+res = sparse_consolidate_segments(seg, 0.5)
+print('%d -> %d: %.2fs' % (len(seg), len(res), time.time() - t0))
+# 5000 -> 1529: 0.05s using get_sparse_overlap_matrix
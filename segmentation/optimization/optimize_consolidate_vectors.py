@@ -0,0 +1,49 @@
+import time
+import numpy as np
+from sklearn.cluster import DBSCAN
+from utils.vector import Vector, VectorCollection, consolidate_vectors
+
+
+def generate_lattice(n, d=100, n_preds=3, noise=5):
+    '''hexagonal lattice of about n sites with spacing d, each site is
+    predicted n_preds times with some gaussian noise'''
+    side = int(np.sqrt(n))
+    rows, cols = np.meshgrid(np.arange(side), np.arange(side), indexing='ij')
+    x = (cols + (rows % 2) / 2) * d
+    y = rows * d * np.sqrt(3) / 2
+    sites = np.stack([x.ravel(), y.ravel()], axis=1)
+    preds = np.repeat(sites, n_preds, axis=0)
+    preds += np.random.normal(scale=noise, size=preds.shape)
+    return VectorCollection.from_array(np.random.permutation(preds))
+
+
+def consolidate_vectors_dbscan(vectors, eps):
+    coords = np.array([(v.y, v.x) for v in vectors])
+    labels = DBSCAN(eps=eps, min_samples=1).fit(coords).labels_
+
+    label2idxs = {label: [] for label in set(labels)}
+    for i, d in enumerate(labels):
+        label2idxs[d].append(i)
+
+    consolidated_vectors = VectorCollection()
+    for d in label2idxs:
+        centroid = coords[label2idxs[d]].mean(axis=0)
+        consolidated_vectors.add(Vector(centroid[1], centroid[0]))
+    return consolidated_vectors
+
+
+for n in [1000, 10000, 40000]:
+    vc = generate_lattice(n)
+
+    t0 = time.time()
+    res_dbscan = consolidate_vectors_dbscan(vc, 50)
+    t1 = time.time()
+    res = consolidate_vectors(vc, 50)
+    t2 = time.time()
+
+    same = np.array_equal(res_dbscan.coords, res.coords)
+    print('%d -> %d: DBSCAN %.2fs, KD-tree + union-find %.2fs, same %s'
+          % (len(vc), len(res), t1 - t0, t2 - t1, same))
+# 2883 -> 961: DBSCAN 0.09s, KD-tree + union-find 0.00s, same True
+# 30000 -> 10000: DBSCAN 0.40s, KD-tree + union-find 0.02s, same True
+# 120000 -> 40000: DBSCAN 2.40s, KD-tree + union-find 0.14s, same True
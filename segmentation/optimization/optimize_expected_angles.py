@@ -0,0 +1,61 @@
+import time
+import numpy as np
+from utils.vector import VectorCollection
+from optimization import refine_segmentation as original
+from utils.angles import predict_expected_angles
+from refine_segmentation.procedure import get_neighbour_distances, get_neighbour_angles
+
+
+def generate_lattice(n, d=100, drop=0.1, noise=5, angle=0.3):
+    '''rotated hexagonal lattice of about n sites with spacing d,
+    some sites are dropped, the others get some gaussian noise'''
+    side = int(np.sqrt(n))
+    rows, cols = np.meshgrid(np.arange(side), np.arange(side), indexing='ij')
+    x = (cols + (rows % 2) / 2) * d
+    y = rows * d * np.sqrt(3) / 2
+    coords = np.stack([x.ravel(), y.ravel()], axis=1)
+    rot = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    coords = coords @ rot.T + np.random.normal(scale=noise, size=coords.shape)
+    coords = coords[np.random.uniform(size=len(coords)) > drop]
+    return VectorCollection.from_array(np.random.permutation(coords))
+
+
+def circular_distance(a, b):
+    return np.abs((np.subtract.outer(a, b) + np.pi) % (2 * np.pi) - np.pi)
+
+
+for n in [1000, 5000, 10000, 40000]:
+    vc = generate_lattice(n)
+    d_mean, d_std = get_neighbour_distances(vc.get_nearest_distances())
+
+    # original: angles from full matrices, DBSCAN
+    t0 = time.time()
+    if n <= 5000:
+        A, D = vc.get_angle_matrix(), vc.get_distance_matrix()
+        D[D <= 0] = np.inf
+        angles = original.get_neighbour_angles(A, D, d_mean + 2 * d_std)
+        t1 = time.time()
+        means_dbscan, std_dbscan = original.predict_expected_angles(angles)
+    t2 = time.time()
+
+    # masked neighbour pairs, circular KDE
+    _, _, D, A = vc.get_neighbours(d_mean + 2 * d_std)
+    angles = get_neighbour_angles(A, D, d_mean + 2 * d_std)
+    t3 = time.time()
+    means, std = predict_expected_angles(angles)
+    t4 = time.time()
+
+    if n <= 5000:
+        diff = circular_distance(means, means_dbscan).min(axis=1).max()
+        print('%d cells, %d angles: loop %.2fs + DBSCAN %.2fs, masked %.3fs + KDE %.3fs, '
+              'max angle diff %.4f, std %.4f / %.4f'
+              % (len(vc), len(angles), t1 - t0, t2 - t1, t3 - t2, t4 - t3, diff, std_dbscan, std))
+    else:
+        print('%d cells, %d angles: masked %.3fs + KDE %.3fs'
+              % (len(vc), len(angles), t3 - t2, t4 - t3))
+# 857 cells, 1705 angles: loop 0.05s + DBSCAN 0.02s, masked 0.001s + KDE 0.001s, max angle diff 1.0464, std 0.0746 / 0.0746
+# 4409 cells, 8651 angles: loop 0.80s + DBSCAN 0.23s, masked 0.010s + KDE 0.003s, max angle diff 1.0491, std 0.0761 / 0.0758
+# 8971 cells, 17778 angles: masked 0.013s + KDE 0.006s
+# 35920 cells, 72216 angles: masked 0.055s + KDE 0.019s
+# the angle diff of 60 degrees is a direction the original drops:
+# its check for an angle appearing at pi and -pi removes a valid one
@@ -0,0 +1,29 @@
+from utils.batch import list_images
+from utils.sweep import sweep, format_table, write_results
+
+data_dir = "data/broodmapper/"
+base_dir = "optimization/"
+
+
+if __name__ == "__main__":
+    # simple gradient with refinement
+    space = {
+        "simple_gradient.procedure": dict(
+            denoise_mask=[2, 3, 4],
+            diam_range=[(130, 300), (150, 300), (170, 300)],
+            expand=[1.1, 1.2, 1.3],
+            max_overlap=[0.3, 0.5],
+        ),
+        "refine_segmentation.procedure": dict(n=[1, 2]),
+    }
+    recs = sweep(list_images(data_dir), "refine_segmentation", space, nproc=3, eta=3)
+    print(format_table(recs, top=15))
+    # 108 configs, 12 survivors after pruning by Pareto layers of F1 and time
+    # on 1, 3, 7 images, 395s in total
+    # pareto  images  TPR    PPV    F1     time   params
+    # *       7       0.926  0.985  0.955  4.42s  denoise 4, diam (150, 300), expand 1.3, overlap 0.3, n 2
+    # *       7       0.915  0.987  0.950  4.38s  denoise 2, diam (150, 300), expand 1.3, overlap 0.3, n 2
+    # *       7       0.929  0.969  0.948  4.30s  denoise 2, diam (150, 300), expand 1.2, overlap 0.5, n 2
+    # *       7       0.932  0.963  0.947  4.06s  denoise 4, diam (150, 300), expand 1.2, overlap 0.3, n 2
+    # the current defaults score 0.936  0.967  0.951  4.98s
+    write_results(recs, base_dir + "results_parameters.json")
@@ -1,6 +1,8 @@
 import time
 import numpy as np
 from utils.vector import VectorCollection, Vector
+from refine_segmentation.procedure import predict_new_vectors as predict_new_vectors_vectorized
+from refine_segmentation2.procedure import predict_new_vectors as predict_new_vectors2_vectorized
 
 
 def generate_vectors(n):
@@ -117,6 +119,18 @@ print('%d -> %d: %.2fs' % (len(vc), len(res), time.time() - t0))
 # 1000 -> 45354: 28.06s reduce scoping and duplicate calcs
 # 1000 -> 39872: 1.46s applied changes from above
 
+# all vectors x angles at once on KD-tree neighbour pairs
+vc = generate_vectors(1000)
+t0 = time.time()
+res = predict_new_vectors_vectorized(vc.get_neighbours(20), vc, angles, 0.1, 2, 1, 20)
+print('%d -> %d: %.2fs' % (len(vc), len(res), time.time() - t0))
+# 1000 -> 3788: 0.03s vectorized
+
+t0 = time.time()
+res = predict_new_vectors2_vectorized(vc.get_neighbours(20, symmetric=True), vc, angles, 0.1, 2, 1)
+print('%d -> %d: %.2fs' % (len(vc), len(res), time.time() - t0))
+# 1000 -> 43577: 0.05s vectorized (neighbours limited to kernel)
+
 t0 = time.time()
 x = 0
 for i in range(len(vc) * len(vc) * len(angles)):
@@ -46,6 +46,10 @@ seg_init = simple_gradient(cropped, diam_range=(60, 150))
 # simpler Segment calculation
 # segments: 0.12s
 
+# bulk extraction with Segmentation.from_labels and fits mask
+# (33152 regions in 5600x3700 label image: regionprops loop 1.55s)
+# segments: 0.25s
+
 
 # Refactoring refine_segmentation
 
@@ -0,0 +1,211 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import breadth_first_order, connected_components
+from scipy.spatial import cKDTree
+from utils.segmentation import consolidate_segments
+from refine_segmentation.procedure import remove_border_segments
+
+# the 3 axes of a hexagonal lattice in lattice coordinates (along a1, a2)
+AXES = np.array([[1, 0], [0, 1], [-1, 1]])
+
+
+def get_displacements(coords, k=6):
+    '''Get displacements of each centroid to its k nearest centroids
+    coords: (n, 2) array of x, y
+    returns (i, j, (m, 2) array of coords[j] - coords[i])
+    '''
+    D, J = cKDTree(coords).query(coords, k=k + 1)
+    I = np.repeat(np.arange(len(coords)), k)
+    J, D = J[:, 1:].ravel(), D[:, 1:].ravel()
+    keep = np.isfinite(D) & (D > 0)
+    I, J = I[keep], J[keep]
+    return I, J, coords[J] - coords[I]
+
+
+def get_steps(V, basis, tol):
+    '''Round displacements to steps of the lattice
+    V: (m, 2) array of displacements
+    basis: (2, 2) array of lattice vectors a1, a2 (rows)
+    tol: max deviation from the lattice relative to the lattice spacing
+    returns (m, 2) int array of steps and bool mask of displacements
+    which are on the lattice
+    '''
+    S = np.rint(V @ np.linalg.inv(basis)).astype(int)
+    err = np.hypot(*(V - S @ basis).T)
+    spacing = np.hypot(*basis.T).mean()
+    return S, (S != 0).any(axis=1) & (err < tol * spacing)
+
+
+def fit_basis(V, spacing, tol=0.25, n_iter=3):
+    '''Fit the lattice vectors of a hexagonal lattice to neighbour displacements
+    The orientation is initialized by the circular mean of 6 times the angles
+    of displacements about as long as `spacing`. Then all displacements are
+    rounded to steps of the lattice and the lattice vectors are fitted to
+    them by least squares, so that sheared lattices (e.g. from photos taken
+    at an angle) fit, too.
+    V: (m, 2) array of displacements of neighbouring centroids
+    spacing: float of expected distance of direct neighbours
+    tol: max deviation from the lattice relative to the lattice spacing
+    n_iter: number of least squares iterations
+    returns (2, 2) array of lattice vectors a1, a2 (rows), None if no
+    displacement is about as long as `spacing`
+    '''
+    L = np.hypot(V[:, 0], V[:, 1])
+    near = np.abs(L - spacing) < tol * spacing
+    if not near.any():
+        return None
+    theta = np.arctan2(V[near, 1], V[near, 0])
+    phi = np.angle(np.exp(6j * theta).mean()) / 6
+    basis = spacing * np.array([
+        [np.cos(phi), np.sin(phi)],
+        [np.cos(phi + np.pi / 3), np.sin(phi + np.pi / 3)]])
+
+    for _ in range(n_iter):
+        S, valid = get_steps(V, basis, tol)
+        if np.linalg.matrix_rank(S[valid]) < 2:
+            break
+        basis = np.linalg.lstsq(S[valid], V[valid], rcond=None)[0]
+    return basis
+
+
+def get_lattice_coords(coords, basis, I, J):
+    '''Assign integer lattice coordinates to centroids
+    Centroids connected by steps on the lattice form a region. Within each
+    region coordinates are accumulated along a breadth-first spanning tree,
+    so curved combs are followed as long as the steps between neighbouring
+    centroids can be told apart.
+    coords: (n, 2) array of x, y
+    basis: (2, 2) array of lattice vectors a1, a2 (rows)
+    I, J: centroids I and J are connected by a step on the lattice
+    returns (n,) int array of regions and (n, 2) int array of lattice coords
+    '''
+    n = len(coords)
+    _, regions = connected_components(
+        coo_matrix((np.ones(len(I)), (I, J)), shape=(n, n)), directed=False)
+
+    # spanning forest from a virtual node linked to one centroid per region
+    _, roots = np.unique(regions, return_index=True)
+    I = np.concatenate([I, np.full(len(roots), n)])
+    J = np.concatenate([J, roots])
+    graph = coo_matrix((np.ones(len(I)), (I, J)), shape=(n + 1, n + 1)).tocsr()
+    _, pred = breadth_first_order(graph, n, directed=False, return_predecessors=True)
+    pred = pred[:n]
+    pred[roots] = roots
+
+    # sum up steps towards the root by pointer jumping
+    lattice = np.rint((coords - coords[pred]) @ np.linalg.inv(basis)).astype(int)
+    while True:
+        grandpred = pred[pred]
+        if (grandpred == pred).all():
+            return regions, lattice
+        lattice += lattice[pred]
+        pred = grandpred
+
+
+def get_missing_sites(regions, lattice, max_gap):
+    '''Get lattice sites in gaps between centroids along the lattice axes
+    Per axis, centroids are sorted by line and position on that line, so
+    gaps are found between consecutive centroids in a single pass.
+    regions, lattice: see get_lattice_coords
+    max_gap: max number of missing sites in a row which are filled
+    returns (m,) int array of regions and (m, 2) int array of lattice coords
+    '''
+    out = [np.zeros((0, 3), dtype=int)]
+    for axis in AXES:
+        # which line (perpendicular offset) and where on that line
+        line = lattice[:, 0] * axis[1] - lattice[:, 1] * axis[0]
+        pos = lattice[:, 1] if axis[1] != 0 else lattice[:, 0]
+        order = np.lexsort((pos, line, regions))
+        r, l, p = regions[order], line[order], pos[order]
+        gap = p[1:] - p[:-1]
+        idxs = np.nonzero(
+            (r[1:] == r[:-1]) & (l[1:] == l[:-1]) & (gap > 1) & (gap <= max_gap + 1))[0]
+
+        # sites 1 .. gap - 1 steps after the centroid before each gap
+        n_sites = gap[idxs] - 1
+        starts = np.cumsum(n_sites) - n_sites
+        step = np.arange(n_sites.sum()) - np.repeat(starts, n_sites) + 1
+        idxs = order[np.repeat(idxs, n_sites)]
+        sites = lattice[idxs] + step[:, None] * axis
+        out.append(np.column_stack([regions[idxs], sites]))
+
+    out = np.unique(np.concatenate(out), axis=0)
+    return out[:, 0], out[:, 1:]
+
+
+def predict_sites(coords, basis, regions, lattice, site_regions, sites, warp=6):
+    '''Predict x, y of lattice sites
+    Each region has its own offset of the lattice. With `warp` the residuals
+    of the nearest centroids of the same region (their deviation from the
+    fitted lattice) are averaged and added, which follows curved combs.
+    coords: (n, 2) array of x, y of centroids
+    basis: (2, 2) array of lattice vectors a1, a2 (rows)
+    regions, lattice: see get_lattice_coords
+    site_regions, sites: see get_missing_sites
+    warp: int number of nearest centroids for local warp (None for no warp)
+    returns (m, 2) array of x, y of sites
+    '''
+    ideal = lattice @ basis
+    residuals = coords - ideal
+    counts = np.bincount(regions)
+    offsets = np.stack([
+        np.bincount(regions, residuals[:, 0]) / counts,
+        np.bincount(regions, residuals[:, 1]) / counts], axis=1)
+    xy = offsets[site_regions] + sites @ basis
+    if warp is None or len(xy) == 0:
+        return xy
+
+    # nearest centroids on the fitted lattice, far from the root of a region
+    # the actual positions may already be off by more than a cell
+    k = min(warp, len(coords))
+    _, J = cKDTree(ideal + offsets[regions]).query(xy, k=k)
+    J = J.reshape(len(xy), k)
+    weights = (regions[J] == site_regions[:, None]).astype(float)
+    deviation = residuals[J] - offsets[site_regions][:, None, :]
+    total = np.maximum(weights.sum(axis=1), 1)[:, None]
+    return xy + (weights[:, :, None] * deviation).sum(axis=1) / total
+
+
+def generate_segmentation(segments, max_gap=4, warp=6, snap=True, tol=0.25):
+    '''Generate Segmentation by filling gaps in a fitted hexagonal lattice
+    Instead of walking from cell to cell over several rounds like in
+    refine_segmentation, the lattice vectors of the honeycomb are fitted to
+    the displacements between neighbouring cells at once. Then every cell
+    gets integer lattice coordinates and all missing cells between
+    identified cells along the 3 axes of the lattice are predicted in a
+    single pass. Each region of cells connected by steps on the lattice has
+    its own offset. As in refine_segmentation predicted segments overlapping
+    identified ones are averaged with them.
+    segments: Segmentation object of initial segmentation
+    max_gap: max number of missing cells in a row which are filled
+    warp: int number of nearest cells for local warp of predicted cells
+          (None to only use the fitted lattice)
+    snap: whether to also predict cells at identified cells close to their
+          site, which evens out their size and position
+    tol: max deviation of neighbours from the lattice relative to its spacing
+    '''
+    coords = segments.centroids[:, ::-1].astype(float)
+    if len(coords) < 3:
+        return remove_border_segments(segments)
+
+    I, J, V = get_displacements(coords)
+    nearest = np.full(len(coords), np.inf)
+    np.minimum.at(nearest, I, np.hypot(V[:, 0], V[:, 1]))
+    basis = fit_basis(V, np.median(nearest), tol=tol)
+    if basis is None:
+        return remove_border_segments(segments)
+    _, valid = get_steps(V, basis, tol)
+    regions, lattice = get_lattice_coords(coords, basis, I[valid], J[valid])
+    site_regions, sites = get_missing_sites(regions, lattice, max_gap)
+    xy = predict_sites(coords, basis, regions, lattice, site_regions, sites, warp=warp)
+    if snap:
+        snapped = predict_sites(coords, basis, regions, lattice, regions, lattice, warp=warp)
+        close = np.hypot(*(snapped - coords).T) < tol * np.hypot(*basis.T).mean() / 2
+        xy = np.concatenate([xy, snapped[close]])
+
+    pad = segments.diams.mean() / 2
+    segments.add_many(np.stack(
+        [xy[:, 0] - pad, xy[:, 0] + pad, xy[:, 1] - pad, xy[:, 1] + pad], axis=1))
+    segments = consolidate_segments(segments, overlap=0.5)
+
+    return remove_border_segments(segments)
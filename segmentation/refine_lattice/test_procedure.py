@@ -0,0 +1,68 @@
+import json
+import numpy as np
+import utils.plot as plot
+from skimage import io, color
+from utils.evaluation import Validation
+from utils.cache import ArrayCache
+from utils.preprocessing import Preprocessor
+from utils.segmentation import Segmentation
+from simple_gradient.procedure import generate_segmentation as simple_gradient
+from refine_lattice.procedure import fit_basis, generate_segmentation as refine_lattice
+
+
+image_names = ['angled', 'capped', 'dark', 'egg', 'empty', 'medium', 'small']
+data_dir = 'data/broodmapper/'
+base_dir = 'refine_lattice/'
+cache = ArrayCache('data/cache/')  # intermediates shared across runs
+
+
+# sparse cells: no displacement is about as long as the median spacing
+# (50 and 200 px, median 125 px), so no lattice is fitted and nothing added
+x = np.array([100, 150, 400, 600])
+seg_sparse = Segmentation(
+    np.stack([x - 20, x + 20, np.full(4, 80), np.full(4, 120)], axis=1),
+    img=np.zeros((200, 800), dtype=np.uint8))
+assert fit_basis(np.array([[50., 0], [250, 0], [200, 0], [450, 0]]), 125) is None
+assert np.array_equal(refine_lattice(seg_sparse).ranges, seg_sparse.ranges)
+
+
+# load original images and do segmentation
+images = dict()
+for image_name in image_names:
+    img = io.imread(data_dir + image_name + '.jpg')
+    seg_init = simple_gradient(
+        img=Preprocessor(img, cache=cache), denoise_mask=3, diam_range=(150, 300),
+        expand=1.2, max_overlap=0.5)
+    seg = refine_lattice(seg_init, max_gap=4, warp=6)
+    images[image_name] = dict(img=img, seg=seg)
+
+
+# validate segmentation with labels
+for image_name in images:
+    labels_path = data_dir + image_name + '_labels.png'
+    val = Validation(images[image_name]['img'], labels_path)
+    val.confuse(images[image_name]['seg'])
+    images[image_name]['val'] = val
+    print(image_name, val)
+# angled <Validation TPR 0.90 PPV 0.97/>
+# capped <Validation TPR 0.88 PPV 0.99/>
+# dark <Validation TPR 0.90 PPV 0.98/>
+# egg <Validation TPR 0.95 PPV 0.90/>
+# empty <Validation TPR 0.99 PPV 0.99/>
+# medium <Validation TPR 0.93 PPV 1.00/>
+# small <Validation TPR 0.96 PPV 0.99/>
+
+
+# see segmentations
+for image_name in images:
+    seg = images[image_name]['seg']
+    val = images[image_name]['val']
+    plot.segmentation(
+        seg.img, seg,
+        title='%s TPR %.2f PPV %.2f' % (image_name, val.TPR, val.PPV),
+        save='%ssegmentations/%s.png' % (base_dir, image_name))
+
+# write results to file
+recs = [dict(img=k, TPR=d['val'].TPR, PPV=d['val'].PPV) for k, d in images.items()]
+with open(base_dir + 'results.json', 'w') as ouf:
+    json.dump(recs, ouf)
@@ -1,14 +1,17 @@
 import numpy as np
 from utils.vector import Vector, VectorCollection, consolidate_vectors
-from utils.segmentation import Segment, Segmentation, consolidate_segments
-from sklearn.cluster import DBSCAN
+from utils.angles import predict_expected_angles, get_missing_directions
+from utils.segmentation import Segmentation, consolidate_segments
+from scipy.spatial import cKDTree
 
 
-def get_neighbour_distances(D):
-    '''Get shortest distances for each row in distance matrix excluding outliers
-    D: eucl. distance matrix (n x n)
+def get_neighbour_distances(min_Ds):
+    '''Get mean and std of shortest distances excluding outliers
+    min_Ds: shortest eucl. distance of each vector to a following vector
+            (see VectorCollection.get_nearest_distances)
     '''
-    min_Ds = np.nanmin(D[:-1], axis=1)
+    # last vector has no following vectors
+    min_Ds = min_Ds[:-1]
 
     # filter out distances which are probably not from direct neighbours
     IQR = np.quantile(min_Ds, 0.75) - np.quantile(min_Ds, 0.25)
@@ -19,114 +22,37 @@ def get_neighbour_distances(D):
 
 
 def get_neighbour_angles(A, D, max_distance):
-    '''Get angles of neighbours from angle matrix
-    Neighbours are identified by a corresponding distance matrix with
+    '''Get angles of neighbours from neighbour pairs
+    Neighbours are identified by their corresponding distances with
     a maximum distance
-    D: eucl. distance matrix (n x n)
-    A: corresponding angle matrix (same shape as D)
+    D: eucl. distances of neighbour pairs
+    A: corresponding angles (same shape as D)
     max_distance: max distance for records to be considered neighbours
     '''
-    angles = []
-    for idx in range(D.shape[0] - 1):
-        idxs_nbs = np.where(D[idx] <= max_distance)[0]
-        if len(idxs_nbs) > 0:
-            angles = angles + list(A[idx, idxs_nbs])
-    return np.array(angles)
-
-
-def predict_expected_angles(angles, expected_clusters=6):
-    '''Predict expected angles from array of observed angles by DBSCAN
-    angles: ndarray of observed angles
-    expected_clusters: int of how many angle clusters to expect at max
-    '''
-    labels = DBSCAN(eps=np.pi / (2 * expected_clusters)) \
-        .fit(angles.reshape(-1, 1)).labels_
-
-    # get mean and std angles for each cluster, -1 are noisy clusters
-    angle_means = []
-    angle_stds = []
-    for label in [d for d in set(labels) if d >= 0]:
-        idxs = [i for i, d in enumerate(labels) if d == label]
-        angle_means.append(angles[idxs].mean())
-        angle_stds.append(angles[idxs].std())
-
-    if len(angle_means) == 0:
-        return [], 0
-
-    # predict angles by scanning expected angle ranges
-    max_std = max(angle_stds)
-    arr = np.array(angle_means)
-
-    def process_angle_range(tetha):
-        found = arr[(arr >= tetha - 2 * max_std) & (arr <= tetha + 2 * max_std)]
-        if found.shape[0] > 0:
-            tetha = found[0]
-        else:
-            angle_means.append(tetha)
-
-    # from one angle walk towards angle pi in expected step-size
-    theta = angle_means[0]
-    while theta <= np.pi:
-        process_angle_range(theta)
-        theta += np.pi / (expected_clusters / 2)
-
-    # then walk towards angle -pi from one angle in expected step-size
-    theta = angle_means[0]
-    while theta >= -np.pi:
-        process_angle_range(theta)
-        theta -= np.pi / (expected_clusters / 2)
-
-    # angles at pi can appear twice (pi and -pi), remove one
-    angle_means = sorted(angle_means)
-    if abs(angle_means[-1]) - abs(angle_means[0]) < np.pi / expected_clusters:
-        angle_means = angle_means[1:]
-    return angle_means, max_std
-
-
-def predict_new_vectors(D, A, vectors, angles, angles_std, max_distance, mean_distance, kernel):
+    return A[D <= max_distance]
+
+
+def predict_new_vectors(neighbours, vectors, angles, angles_std, max_distance, mean_distance, kernel):
     '''From angles and distances predict new vectors
     For each vector look into expected directions and see if there is a direct
     neighbour. If there is no direct neighbour but further down this direction
     there is another vector, then we add a vector as direct neighbour.
-    D: eucl. distance matrix (unecessary values should be Inf)
-    A: angles matrix (of same shape as D)
+    All vectors and directions are evaluated at once (see get_missing_directions).
+    neighbours: (i, j, distance, angle) arrays of neighbour pairs
+                (see VectorCollection.get_neighbours)
     vectors: VectorCollection object of existing vectors
     angles: iter directions of expected neighbours
     angles_std: std of those directions
     max_distance: float of max eucl. distance in which we expect a neighbour
     mean_distance: float of mean eucl. distance in which we expect a neighbour
     kernel: float eucl. distance of kernel to use when searching neighbours
+    returns (m, 2) array of x, y of predicted vectors
     '''
-
-    def above_pi(t, h, l): return t <= h - 2 * np.pi or t >= l
-
-    def below_pi(t, h, l): return t >= 2 * np.pi + l or t <= h
-
-    def within_pi(t, h, l): return t <= h and t >= l
-
-    out = VectorCollection()
-    for idx in range(len(vectors)):
-        d = D[idx]
-        a = A[idx]
-
-        for angle in angles:
-            hi = angle + angles_std
-            lo = angle - angles_std
-
-            if hi > np.pi:
-                is_in_direction = above_pi
-            elif lo < -np.pi:
-                is_in_direction = below_pi
-            else:
-                is_in_direction = within_pi
-
-            idxs_ker = np.where(d <= kernel)[0]
-            idxs_ang = [i for i in idxs_ker if is_in_direction(a[i], hi, lo)]
-
-            if len(idxs_ang) > 0 and not any(d[idxs_ang] <= max_distance):
-                out.add(vectors[idx] + Vector.from_angle(angle, mean_distance))
-
-    return out
+    idxs, angle_idxs, _ = get_missing_directions(
+        neighbours, len(vectors), angles, angles_std, max_distance, kernel)
+    steps = [Vector.from_angle(angle, mean_distance) for angle in angles]
+    steps = np.array([(v.x, v.y) for v in steps]).reshape(-1, 2)
+    return vectors.coords[idxs] + steps[angle_idxs]
 
 
 def remove_border_segments(segments):
@@ -136,55 +62,88 @@ def remove_border_segments(segments):
     larger than the 2 encapsulating segments and thus span over the border
     of the image.
     '''
-    out = Segmentation(img=segments.img)
     xmax = segments.img.shape[1]
     ymax = segments.img.shape[0]
-    for i in range(len(segments)):
-        s = segments[i]
-        if min(s.xrange + s.yrange) > 0 and \
-           max(s.xrange) <= xmax and \
-           max(s.yrange) <= ymax:
-            out.add(s)
-    return out
+    keep = (segments.ranges.min(axis=1) > 0) & \
+        (segments.xranges.max(axis=1) <= xmax) & \
+        (segments.yranges.max(axis=1) <= ymax)
+    return segments[keep]
+
+
+def get_changed_cells(old, new, max_distance):
+    '''Compare cells of 2 segmentations
+    A cell is new (or removed) if there is no cell within `max_distance`
+    in the other segmentation, segments which merely moved a bit
+    are not considered.
+    returns (m, 2) array of x, y of new and removed cells
+    '''
+    a = old.centroids[:, ::-1].astype(float)
+    b = new.centroids[:, ::-1].astype(float)
+    if len(a) == 0 or len(b) == 0:
+        return np.concatenate([a, b])
+    d_new, _ = cKDTree(a).query(b, distance_upper_bound=max_distance)
+    d_removed, _ = cKDTree(b).query(a, distance_upper_bound=max_distance)
+    return np.concatenate([b[np.isinf(d_new)], a[np.isinf(d_removed)]])
 
 
-def generate_segmentation(segments, n=2):
+def generate_segmentation(segments, n=2, incremental=False, max_rounds=20):
     '''Generate Segmentation by iteratively improving an initial segmentation
     Using an initial segmentation, we iteratively look at all the identified
     segments and see if they should have neighbours which are not yet identified.
     This is based on the usual neighbourhood of the existing segmentation.
+    In incremental mode the expected angles of the first round are kept and
+    afterwards only segments within the kernel of cells which were added or
+    removed in the previous round (the frontier) look for missing neighbours.
+    This is a heuristic: distances are still recomputed each round and
+    segments are reordered by consolidation, so predictions outside the
+    frontier could change as well. Results differ slightly from full rounds.
     seg: Segmentation object of initial segmentation
-    n: int number of iterations (0 ^= do nothing)
+    n: int number of iterations (0 ^= do nothing),
+       None to iterate until no cells are added or removed anymore
+    incremental: whether to only look at the frontier after the first round
+    max_rounds: max number of iterations if `n` is None
     '''
-    for round in range(n):
-        n_segments = len(segments)
-        diams = np.ndarray((n_segments, 2))
-        vectors = VectorCollection()
-        for i in range(n_segments):
-            s = segments[i]
-            diams[i] = s.get_diams()
-            vectors.add(Vector(*reversed(s.get_centroid())))
-
-        A = vectors.get_angle_matrix()
-        D = vectors.get_distance_matrix()
-        D[D <= 0] = np.inf
-
-        d_mean, d_std = get_neighbour_distances(D)
-        neighbour_angles = get_neighbour_angles(A, D, d_mean + 2 * d_std)
-        angles, angle_std = predict_expected_angles(neighbour_angles)
-        vectors = predict_new_vectors(
-            D=D, A=A, vectors=vectors, angles=angles,
+    rounds = max_rounds if n is None else n
+    changed = None
+    for round in range(rounds):
+        diams = segments.diams
+        vectors = VectorCollection.from_array(segments.centroids[:, ::-1])
+
+        d_mean, d_std = get_neighbour_distances(vectors.get_nearest_distances())
+        kernel = (d_mean + d_std) * 10
+        if changed is None:
+            _, _, D, A = vectors.get_neighbours(d_mean + 2 * d_std)
+            neighbour_angles = get_neighbour_angles(A, D, d_mean + 2 * d_std)
+            angles, angle_std = predict_expected_angles(neighbour_angles)
+
+        # vectors within kernel of changes of last round
+        frontier = None
+        if changed is not None:
+            dist, _ = cKDTree(changed).query(vectors.coords, distance_upper_bound=kernel)
+            frontier = np.nonzero(dist <= kernel)[0]
+        neighbours = vectors.get_neighbours(kernel, idxs=frontier)
+
+        new_coords = predict_new_vectors(
+            neighbours=neighbours, vectors=vectors, angles=angles,
             angles_std=2 * angle_std,
             max_distance=d_mean + d_std,
             mean_distance=d_mean,
-            kernel=(d_mean + d_std) * 10)
+            kernel=kernel)
 
+        vectors = VectorCollection.from_array(new_coords)
         vectors = consolidate_vectors(vectors, d_mean / 2)
         pad = diams.mean() / 2
-        for i in range(len(vectors)):
-            v = vectors[i]
-            segments.add(Segment([v.x - pad, v.x + pad], [v.y - pad, v.y + pad]))
+        previous = Segmentation(segments.ranges.copy())
+        segments.add_many(np.stack(
+            [vectors.x - pad, vectors.x + pad, vectors.y - pad, vectors.y + pad], axis=1))
 
         segments = consolidate_segments(segments, overlap=0.5)
 
+        # without changes further rounds can only repeat this one
+        cells = get_changed_cells(previous, segments, d_mean / 2)
+        if len(cells) == 0 and (n is None or incremental):
+            break
+        if incremental:
+            changed = cells
+
     return remove_border_segments(segments)
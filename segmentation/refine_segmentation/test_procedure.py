@@ -3,6 +3,8 @@ import numpy as np
 import utils.plot as plot
 from skimage import io, color
 from utils.evaluation import Validation
+from utils.cache import ArrayCache
+from utils.preprocessing import Preprocessor
 from utils.segmentation import consolidate_segments
 from simple_gradient.procedure import generate_segmentation as simple_gradient
 from refine_segmentation.procedure import generate_segmentation as refine_segmentation
@@ -11,6 +13,7 @@ from refine_segmentation.procedure import generate_segmentation as refine_segmen
 image_names = ['angled', 'capped', 'dark', 'egg', 'empty', 'medium', 'small']
 data_dir = 'data/broodmapper/'
 base_dir = 'refine_segmentation/'
+cache = ArrayCache('data/cache/')  # intermediates shared across runs
 
 
 # load original images and do segmentation
@@ -18,7 +21,7 @@ images = dict()
 for image_name in image_names:
     img = io.imread(data_dir + image_name + '.jpg')
     seg_init = simple_gradient(
-        img=img, denoise_mask=3, diam_range=(150, 300),
+        img=Preprocessor(img, cache=cache), denoise_mask=3, diam_range=(150, 300),
         expand=1.2, max_overlap=0.5)
     seg = refine_segmentation(seg_init, n=2)
     images[image_name] = dict(img=img, seg=seg)
@@ -34,7 +37,7 @@ for image_name in images:
 # angled <Validation TPR 0.89 PPV 0.94/>
 # capped <Validation TPR 0.87 PPV 0.96/>
 # dark <Validation TPR 0.90 PPV 0.98/>
-# egg <Validation TPR 0.96 PPV 0.91/>
+# egg <Validation TPR 0.97 PPV 0.91/>
 # empty <Validation TPR 1.00 PPV 0.99/>
 # medium <Validation TPR 0.94 PPV 1.00/>
 # small <Validation TPR 0.98 PPV 0.97/>
@@ -3,6 +3,8 @@ import numpy as np
 import utils.plot as plot
 from skimage import io, color
 from utils.evaluation import Validation
+from utils.cache import ArrayCache
+from utils.preprocessing import Preprocessor
 from utils.segmentation import consolidate_segments
 from simple_gradient.procedure import generate_segmentation as simple_gradient
 from refine_segmentation2.procedure import generate_segmentation
@@ -11,13 +13,14 @@ from refine_segmentation2.procedure import generate_segmentation
 image_names = ['angled', 'capped', 'dark', 'egg', 'empty', 'medium', 'small']
 data_dir = 'data/broodmapper/'
 base_dir = 'refine_segmentation2/'
+cache = ArrayCache('data/cache/')  # intermediates shared across runs
 
 
 # load original images and do segmentation
 images = dict()
 for image_name in image_names:
     img = io.imread(data_dir + image_name + '.jpg')
-    seg_init = simple_gradient(img)
+    seg_init = simple_gradient(Preprocessor(img, cache=cache))
     seg = generate_segmentation(seg_init)
     images[image_name] = dict(img=img, seg=seg)
 
@@ -29,13 +32,13 @@ for image_name in images:
     val.confuse(images[image_name]['seg'])
     images[image_name]['val'] = val
     print(image_name, val)
-# angled <Validation TPR 0.94 PPV 0.97/>
-# capped <Validation TPR 0.90 PPV 1.00/>
-# dark <Validation TPR 0.93 PPV 0.93/>
-# egg <Validation TPR 0.96 PPV 0.87/>
-# empty <Validation TPR 0.99 PPV 0.96/>
-# medium <Validation TPR 0.96 PPV 0.96/>
-# small <Validation TPR 0.96 PPV 0.95/>
+# angled <Validation TPR 0.90 PPV 0.96/>
+# capped <Validation TPR 0.79 PPV 0.91/>
+# dark <Validation TPR 0.88 PPV 0.96/>
+# egg <Validation TPR 0.95 PPV 0.90/>
+# empty <Validation TPR 0.99 PPV 0.99/>
+# medium <Validation TPR 0.93 PPV 1.00/>
+# small <Validation TPR 0.94 PPV 0.95/>
 
 
 # see segmentations
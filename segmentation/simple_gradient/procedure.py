@@ -1,55 +1,124 @@
-import warnings
 import numpy as np
-from utils.segmentation import Segment, Segmentation, consolidate_segments
-from skimage import segmentation, measure, exposure, color
-from skimage.filters import threshold_otsu, rank, gaussian
+from utils.segmentation import Segmentation, consolidate_segments
+from utils.preprocessing import get_preprocessor, to_gray
+from skimage import segmentation, measure, transform
+from skimage.filters import threshold_otsu, gaussian, sobel
 from skimage.morphology import disk, white_tophat
 
+# version of get_labels, part of its cache key, bump it when get_labels changes
+LABELS_VERSION = 1
 
-def generate_segmentation(img, denoise_mask=3, diam_range=(150, 300), expand=1.2, max_overlap=0.5):
-    '''create Segmentation object from gray-scale np image
-    denoise_mask: mask used for denoising image in the beginning
-    diam_range: min, max diam allowed for each cell in px; chose from min
-                (just around edges of cell) to max (half into neighbor cells)
-    expand: float by which to expand the region which was identified as a segment
-    max_overlap: float of maximum relative overlap 2 segmentas can have
-    '''
-    gradient_mask = 3 if diam_range[0] > 100 else 1
-    area_range = tuple(d**2 for d in diam_range)
-    gray = color.rgb2gray(img)
-
-    # denoise
-    denoised = gaussian(gray, denoise_mask)
 
-    # contrast stretching for normalization
-    p2, p98 = np.percentile(denoised, (2, 98))
-    normed = exposure.rescale_intensity(denoised, in_range=(p2, p98))
-
-    # image gradient
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        grad = rank.gradient(normed, disk(gradient_mask))
+def get_labels(pre, denoise_mask, gradient_mask, tophat):
+    '''label image of thresholded gradient
+    pre: utils.preprocessing.Preprocessor of image
+    other parameters as in generate_segmentation
+    '''
+    # denoise, contrast stretching for normalization and image gradient
+    grad = pre.gradient(gradient_mask, sigma=denoise_mask)
 
     # try to seperate gradients if very close together
-    if gradient_mask < 3:
+    if tophat:
         grad = white_tophat(grad, disk(denoise_mask))
 
     # thresholding
     thr = threshold_otsu(grad)
-    markers = np.zeros(grad.shape, dtype=float)
-    markers[grad > thr] = 1
+    markers = grad > thr
 
     # labels
     cleared = segmentation.clear_border(markers)
     labels = measure.label(cleared)
+    return labels
+
+
+def generate_segmentation(img, denoise_mask=3, diam_range=(150, 300), expand=1.2, max_overlap=0.5,
+                          gradient_mask=None, tophat=None):
+    '''create Segmentation object from gray-scale np image
+    img: color np image or utils.preprocessing.Preprocessor of it
+    denoise_mask: mask used for denoising image in the beginning
+    diam_range: min, max diam allowed for each cell in px; chose from min
+                (just around edges of cell) to max (half into neighbor cells)
+    expand: float by which to expand the region which was identified as a segment
+    max_overlap: float of maximum relative overlap 2 segmentas can have
+    gradient_mask: mask used for computing gradient (default depends on diam_range)
+    tophat: whether to apply white tophat to gradient (default if gradient_mask < 3)
+    '''
+    if gradient_mask is None:
+        gradient_mask = 3 if diam_range[0] > 100 else 1
+    if tophat is None:
+        tophat = gradient_mask < 3
+    pre = get_preprocessor(img)
+
+    labels = pre.cached(
+        ("simple_gradient.labels", LABELS_VERSION, denoise_mask, gradient_mask, tophat),
+        lambda: get_labels(pre, denoise_mask, gradient_mask, tophat))
 
     # capture labeled regions in rectangles
-    seg = Segmentation(img=img)
-    for region in measure.regionprops(labels):
-        minr, minc, maxr, maxc = region.bbox
-        x = maxc - minc
-        y = maxr - minr
-        if min([x, y]) > diam_range[0] and max([x, y]) < diam_range[1]:
-            seg.add(Segment.from_region(region=region, expand=expand))
+    regions = Segmentation.from_labels(labels, img=pre.img)
+    seg = regions[regions.fits(diam_range=diam_range)].expanded(expand)
 
     return consolidate_segments(seg, overlap=max_overlap)
+
+
+def refine_edges(img, seg, window, expand=1.2):
+    '''Snap segment edges to the strongest local gradient in full resolution
+    Only a small window around each segment is looked at. For each edge of the
+    (not yet expanded) segment the row/col with the highest mean gradient
+    within +/- `window` px is chosen, then the segment is expanded again.
+    img: color np image in full resolution
+    seg: Segmentation in full resolution coordinates
+    window: int px by which edges may move
+    expand: float by which segments in `seg` were expanded
+    '''
+    def snap(profile, pos):
+        lo = min(max(pos - window, 0), len(profile) - 1)
+        hi = max(min(pos + window + 1, len(profile)), lo + 1)
+        return lo + int(np.argmax(profile[lo:hi]))
+
+    H, W = img.shape[:2]
+    centers = np.stack([seg.xranges.mean(axis=1), seg.yranges.mean(axis=1)], axis=1)
+    halfs = seg.diams / expand / 2
+    ranges = np.ndarray((len(seg), 4))
+    for i, ((cx, cy), (hx, hy)) in enumerate(zip(centers, halfs)):
+        wx0, wx1 = max(int(cx - hx) - 2 * window, 0), min(int(cx + hx) + 2 * window, W)
+        wy0, wy1 = max(int(cy - hy) - 2 * window, 0), min(int(cy + hy) + 2 * window, H)
+        grad = sobel(gaussian(to_gray(img[wy0:wy1, wx0:wx1]), 1))
+        cols = grad.mean(axis=0)
+        rows = grad.mean(axis=1)
+        x0, x1 = snap(cols, int(cx - hx) - wx0) + wx0, snap(cols, int(cx + hx) - wx0) + wx0
+        y0, y1 = snap(rows, int(cy - hy) - wy0) + wy0, snap(rows, int(cy + hy) - wy0) + wy0
+        xpad = (x1 - x0) * (expand - 1) / 2
+        ypad = (y1 - y0) * (expand - 1) / 2
+        ranges[i] = (x0 - xpad, x1 + xpad, y0 - ypad, y1 + ypad)
+    return Segmentation(ranges, img=img)
+
+
+def generate_segmentation_pyramid(img, denoise_mask=3, diam_range=(150, 300), expand=1.2, max_overlap=0.5,
+                                  min_diam=75, refine=False):
+    '''create Segmentation object by detecting cells on a downscaled image first
+    The image is downscaled by an integer factor chosen from `diam_range`, so
+    that the smallest expected cell is still at least `min_diam` px wide.
+    Segments are mapped back to full resolution coordinates.
+    denoise_mask, diam_range, expand, max_overlap: as in generate_segmentation
+                  (in full resolution px)
+    min_diam: min diam in px a cell should have in the downscaled image
+    refine: whether to snap segment edges to the full resolution gradient
+    '''
+    factor = max(int(diam_range[0] // min_diam), 1)
+    if factor == 1:
+        return generate_segmentation(
+            img, denoise_mask=denoise_mask, diam_range=diam_range,
+            expand=expand, max_overlap=max_overlap)
+
+    small = transform.downscale_local_mean(img, (factor, factor, 1))
+    small = np.round(small).astype(np.uint8)
+    seg = generate_segmentation(
+        small, denoise_mask=denoise_mask / factor,
+        diam_range=tuple(d / factor for d in diam_range),
+        expand=expand, max_overlap=max_overlap,
+        gradient_mask=1, tophat=False)
+
+    seg = Segmentation(seg.ranges * factor, img=img)
+    if refine:
+        seg = refine_edges(img, seg, window=factor, expand=expand)
+    return seg
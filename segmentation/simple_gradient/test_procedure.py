@@ -3,12 +3,15 @@ import numpy as np
 import utils.plot as plot
 from skimage import io, color
 from utils.evaluation import Validation
+from utils.cache import ArrayCache
+from utils.preprocessing import Preprocessor
 from simple_gradient.procedure import generate_segmentation
 
 
 image_names = ['angled', 'capped', 'dark', 'egg', 'empty', 'medium', 'small']
 data_dir = 'data/broodmapper/'
 base_dir = 'simple_gradient/'
+cache = ArrayCache('data/cache/')  # intermediates shared across runs
 
 
 # load original images and do segmentation
@@ -16,7 +19,7 @@ images = dict()
 for image_name in image_names:
     img = io.imread(data_dir + image_name + '.jpg')
     seg = generate_segmentation(
-        img, denoise_mask=3, diam_range=(150, 300),
+        Preprocessor(img, cache=cache), denoise_mask=3, diam_range=(150, 300),
         expand=1.2, max_overlap=0.5)
     images[image_name] = dict(img=img, seg=seg)
 
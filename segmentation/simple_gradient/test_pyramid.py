@@ -0,0 +1,41 @@
+import json
+import time
+import numpy as np
+from skimage import io
+from utils.evaluation import Validation
+from simple_gradient.procedure import generate_segmentation, generate_segmentation_pyramid
+
+
+image_names = ['angled', 'capped', 'dark', 'egg', 'empty', 'medium', 'small']
+data_dir = 'data/broodmapper/'
+base_dir = 'simple_gradient/'
+
+
+# segmentation in full resolution vs on downscaled image
+procedures = dict(
+    full=lambda img: generate_segmentation(img),
+    pyramid=lambda img: generate_segmentation_pyramid(img),
+    pyramid_refined=lambda img: generate_segmentation_pyramid(img, refine=True))
+
+recs = []
+for image_name in image_names:
+    img = io.imread(data_dir + image_name + '.jpg')
+    val = Validation(img, data_dir + image_name + '_labels.png')
+    for name, procedure in procedures.items():
+        t0 = time.time()
+        seg = procedure(img)
+        t1 = time.time() - t0
+        val.confuse(seg)
+        recs.append(dict(img=image_name, procedure=name, TPR=val.TPR, PPV=val.PPV, time=t1))
+        print(image_name, name, val, '%.2fs' % t1)
+
+for name in procedures:
+    res = np.array([(d['TPR'], d['PPV'], d['time']) for d in recs if d['procedure'] == name])
+    print('%s: TPR %.2f PPV %.2f %.2fs per image' % (name, *res.mean(axis=0)))
+# full: TPR 0.84 PPV 0.96 1.72s per image
+# pyramid: TPR 0.81 PPV 0.94 0.71s per image
+# pyramid_refined: TPR 0.80 PPV 0.94 0.92s per image
+
+# write results to file
+with open(base_dir + 'results_pyramid.json', 'w') as ouf:
+    json.dump(recs, ouf)
@@ -1,39 +1,24 @@
-import warnings
-import numpy as np
-from utils.segmentation import Segment, Segmentation, consolidate_segments
-from skimage import segmentation, measure, exposure, color
-from skimage.filters import threshold_otsu, rank
-from skimage.morphology import disk
+from utils.segmentation import Segmentation, consolidate_segments
+from utils.preprocessing import get_preprocessor
+from skimage import segmentation, measure
+from skimage.filters import threshold_otsu
 from scipy.ndimage import binary_fill_holes
-from skimage.util import img_as_ubyte
 
+# version of get_labels, part of its cache key, bump it when get_labels changes
+LABELS_VERSION = 1
 
-def generate_segmentation(img, denoise_mask=3, diam_range=(150, 500), max_overlap=0.5):
-    '''create Segmentation object from gray-scale np image
-    denoise_mask: mask used for denoising image in the beginning
-    diam_range: min, max diam allowed for each cell in px; chose from min
-                (just around edges of cell) to max (half into neighbor cells)
-    max_overlap: float of maximum relative overlap 2 segmentas can have
-    '''
-    area_range = tuple(d**2 for d in diam_range)
-
-    # gray scale
-    gray = color.rgb2gray(img)
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        gray = img_as_ubyte(gray)
 
-    # denoise
-    denoised = rank.median(gray, disk(denoise_mask))
-
-    # contrast stretching for normalization
-    p2, p98 = np.percentile(denoised, (2, 98))
-    normed = exposure.rescale_intensity(denoised, in_range=(p2, p98))
+def get_labels(pre, denoise_mask):
+    '''label image of thresholded denoised image
+    pre: utils.preprocessing.Preprocessor of image
+    other parameters as in generate_segmentation
+    '''
+    # denoise and contrast stretching for normalization
+    normed = pre.stretched(median=denoise_mask)
 
     # thresholding
     thr = threshold_otsu(normed)
-    markers = np.zeros(normed.shape, dtype=float)
-    markers[normed < thr] = 1
+    markers = normed < thr
 
     # refine
     filled = binary_fill_holes(markers)
@@ -41,12 +26,26 @@ def generate_segmentation(img, denoise_mask=3, diam_range=(150, 500), max_overla
 
     # get labels
     labels = measure.label(cleared)
+    return labels
+
+
+def generate_segmentation(img, denoise_mask=3, diam_range=(150, 500), max_overlap=0.5):
+    '''create Segmentation object from gray-scale np image
+    img: color np image or utils.preprocessing.Preprocessor of it
+    denoise_mask: mask used for denoising image in the beginning
+    diam_range: min, max diam allowed for each cell in px; chose from min
+                (just around edges of cell) to max (half into neighbor cells)
+    max_overlap: float of maximum relative overlap 2 segmentas can have
+    '''
+    area_range = tuple(d**2 for d in diam_range)
+    pre = get_preprocessor(img)
+
+    labels = pre.cached(
+        ("simple_thresholding.labels", LABELS_VERSION, denoise_mask),
+        lambda: get_labels(pre, denoise_mask))
 
     # capture labeled regions in rectangles
-    seg = Segmentation(img)
-    for region in measure.regionprops(labels):
-        s = Segment.from_region(region, labels)
-        if s.fits(max_ar=1.5, diam_range=diam_range, area_range=area_range):
-            seg.add(s)
+    seg = Segmentation.from_labels(labels, img=pre.img).expanded(1.2)
+    seg = seg[seg.fits(diam_range=diam_range, area_range=area_range, max_ar=1.5)]
 
     return consolidate_segments(seg, overlap=max_overlap)
@@ -3,19 +3,22 @@ import numpy as np
 import utils.plot as plot
 from skimage import io, color
 from utils.evaluation import Validation
+from utils.cache import ArrayCache
+from utils.preprocessing import Preprocessor
 from simple_thresholding.procedure import generate_segmentation
 
 
 image_names = ['angled', 'capped', 'dark', 'egg', 'empty', 'medium', 'small']
 data_dir = 'data/broodmapper/'
 base_dir = 'simple_thresholding/'
+cache = ArrayCache('data/cache/')  # intermediates shared across runs
 
 
 # load original images and do segmentation
 images = dict()
 for image_name in image_names:
     img = io.imread(data_dir + image_name + '.jpg')
-    seg = generate_segmentation(img)
+    seg = generate_segmentation(Preprocessor(img, cache=cache))
     images[image_name] = dict(img=img, seg=seg)
 
 
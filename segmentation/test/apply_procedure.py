@@ -1,19 +1,24 @@
-import json
 import os
 import shutil
-import time
 import numpy as np
-import utils.plot as plot
-from skimage import io
-from utils.evaluation import Validation
+from functools import partial
+from utils.batch import list_images, register, run_batch
+from utils.export import CropWriter
 from simple_gradient.procedure import generate_segmentation as simple_gradient
-from refine_segmentation.procedure import generate_segmentation as refine_segmentation
-from multiprocessing import Pool
 
 data_dir = "data/test/"
 base_dir = "test/"
+savedir = "%ssegmentations" % base_dir
+results_path = "%sresults.jsonl" % base_dir
+crops_dir = "%ssegments/crops" % base_dir
 nproc = 3
-write_segments = False
+chunksize = 1
+write_segments = False  # crops of all segments as one tensor per image
+crop_size = (150, 150)
+diam_range = (60, 150)
+tile_size = None  # e.g. 1200 to segment in tiles with bounded memory
+
+register("tiled_refine_segmentation", "utils.tiling", "refine_segmentation.procedure")
 
 
 def crop_image(img, hi=460, lo=640, le=100, ri=100, pad=0.1):
@@ -31,34 +36,41 @@ def reset_dir(dirpath):
     os.mkdir(dirpath)
 
 
-def process(file):
-    img = io.imread(data_dir + file["file_name"])
-    cropped = crop_image(img)
-    t0 = time.time()
-    seg_init = simple_gradient(cropped, diam_range=(60, 150))
-    seg = refine_segmentation(seg_init)
-    t1 = time.time() - t0
-    plot.segmentation(
-        cropped,
-        seg,
-        title="%s %.2fs" % (file["file_name"], t1),
-        save="%s/%s" % (savedir, file["file_name"]),
-    )
-
-    if write_segments:
-        s_dir = "%s%s%s" % (base_dir, "segments/", file["name"])
-        reset_dir(s_dir)
-        for s_name in seg.names:
-            s = seg.get(s_name, img=True)
-            io.imsave("%s/%s.png" % (s_dir, s.name), s.img)
+def get_name(path):
+    return "BFD" + os.path.basename(path).split(" ")[-1].split(".")[0]
 
 
 if __name__ == "__main__":
-    savedir = "%ssegmentations" % base_dir
-    files = []
-    for f in os.listdir(data_dir):
-        files.append(dict(name="BFD" + f.split(" ")[-1].split(".")[0], file_name=f))
+    if tile_size is None:
+        procedure = "refine_segmentation"
+        params = {"simple_gradient.procedure": dict(diam_range=diam_range)}
+    else:
+        procedure = "tiled_refine_segmentation"
+        params = {
+            "utils.tiling": dict(
+                procedure=partial(simple_gradient, diam_range=diam_range),
+                diam_range=diam_range,
+                tile_size=tile_size,
+            )
+        }
 
     reset_dir(savedir)
-    with Pool(nproc) as p:
-        p.map(process, files)
+    if write_segments:
+        reset_dir(crops_dir)
+    times = []
+    with CropWriter(crops_dir, size=crop_size, transform=crop_image) as writer:
+        for rec in run_batch(
+            list_images(data_dir),
+            procedure,
+            results_path,
+            params=params,
+            nproc=nproc,
+            chunksize=chunksize,
+            transform=crop_image,
+            plot_dir=savedir,
+        ):
+            times.append(rec["time"])
+            print("%s: %d segments %.2fs" % (rec["img"], rec["n"], rec["time"]))
+            if write_segments:
+                writer.write(get_name(rec["img"]), data_dir + rec["img"], rec["segments"])
+    print("mean %.2fs per image" % np.mean(times))
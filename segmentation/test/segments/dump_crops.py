@@ -0,0 +1,11 @@
+"""Dump exported crops as single images
+Writes the crops in ./crops/ (see apply_procedure.py with write_segments)
+as ./<image name>/<segment name>.png, which can then be labeled by moving
+them into class subdirectories (see process_segments.py).
+"""
+from utils.export import dump_crops
+
+basedir = "test/segments/"
+
+n = dump_crops(basedir + "crops/", basedir)
+print("Wrote %d crops" % n)
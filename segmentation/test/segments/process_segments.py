@@ -22,8 +22,8 @@ labels = [
 # reset all/
 if os.path.isdir(targetdir):
     shutil.rmtree(targetdir)
-    subdirs = [d for d in os.listdir(basedir) if os.path.isdir(basedir + d)]
-    os.mkdir(targetdir)
+subdirs = [d for d in os.listdir(basedir) if os.path.isdir(basedir + d)]
+os.mkdir(targetdir)
 
 # collect files
 labeled_files = {}
@@ -31,6 +31,9 @@ for label in labels:
     labeled_files[label] = []
     for subdir in subdirs:
         curdir = basedir + subdir + "/" + label + "/"
+        # e.g. crops/ or images without cells of this class
+        if not os.path.isdir(curdir):
+            continue
         files = os.listdir(curdir)
         for file in files:
             if os.path.isfile(curdir + file) and file[0] != ".":
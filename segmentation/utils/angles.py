@@ -0,0 +1,106 @@
+import numpy as np
+from scipy import ndimage
+
+
+def predict_expected_angles(angles, expected_clusters=6, bins=360, min_samples=5):
+    '''Predict expected angles from array of observed angles by a circular KDE
+    Angles are binned into a histogram around the circle which is smoothed
+    by a gaussian kernel (wrapping around at +/-pi). Peaks at least
+    pi / `expected_clusters` apart are cluster centers, each cluster takes
+    the angles within pi / (2 * `expected_clusters`) of its center.
+    Without any peak evenly spaced angles are returned.
+    angles: ndarray of observed angles
+    expected_clusters: int of how many angle clusters to expect at max
+    bins: int number of histogram bins
+    min_samples: int min number of angles in a cluster
+    '''
+    angles = np.asarray(angles, dtype=float).ravel()
+    if len(angles) == 0:
+        return [], 0
+
+    # smoothed circular histogram
+    width = 2 * np.pi / bins
+    idxs = np.floor((angles + np.pi) / width).astype(int) % bins
+    density = ndimage.gaussian_filter1d(
+        np.bincount(idxs, minlength=bins).astype(float), sigma=2, mode='wrap')
+
+    # peaks are maxima within +/- pi / expected_clusters (first of plateaus)
+    size = 2 * int(np.pi / expected_clusters / width) + 1
+    peaks = np.nonzero(
+        (density == ndimage.maximum_filter1d(density, size, mode='wrap'))
+        & (density > np.roll(density, 1)))[0]
+    peaks = peaks[np.argsort(-density[peaks])][:expected_clusters]
+    if len(peaks) == 0:
+        # flat density, no direction stands out
+        steps = np.arange(expected_clusters) * (2 * np.pi / expected_clusters)
+        return (steps - np.pi).tolist(), np.pi / (2 * expected_clusters)
+    centers = (peaks + 0.5) * width - np.pi
+
+    # assign angles to closest center, mean and std of circular differences
+    diffs = (angles[:, None] - centers[None, :] + np.pi) % (2 * np.pi) - np.pi
+    labels = np.abs(diffs).argmin(axis=1)
+    diffs = diffs[np.arange(len(angles)), labels]
+    inside = np.abs(diffs) <= np.pi / (2 * expected_clusters)
+    labels, diffs = labels[inside], diffs[inside]
+    counts = np.bincount(labels, minlength=len(centers))
+    found = counts >= max(min_samples, 1)
+    if not found.any():
+        return [], 0
+    counts = counts[found]
+    means = np.bincount(labels, diffs, minlength=len(centers))[found] / counts
+    sq = np.bincount(labels, diffs ** 2, minlength=len(centers))[found] / counts
+    max_std = np.sqrt(np.maximum(sq - means ** 2, 0)).max()
+    means = (centers[found] + means + np.pi) % (2 * np.pi) - np.pi
+
+    # add expected angles in steps of 2 pi / expected_clusters from the
+    # largest cluster where there is no cluster within 2 stds
+    steps = np.arange(expected_clusters) * (2 * np.pi / expected_clusters)
+    expected = (means[np.argmax(counts)] + steps + np.pi) % (2 * np.pi) - np.pi
+    dists = np.abs((expected[:, None] - means[None, :] + np.pi) % (2 * np.pi) - np.pi)
+    missing = expected[~(dists <= 2 * max_std).any(axis=1)]
+    angle_means = sorted(np.concatenate([means, missing]).tolist())
+    return angle_means, max_std
+
+
+def is_in_direction(theta, angles, angles_std):
+    '''Check which angles lie within +/- `angles_std` of the expected directions
+    Windows reaching over +/-pi wrap around to the other side.
+    theta: ndarray of m radian angles
+    angles: iter of k expected directions
+    angles_std: half width of the angular window
+    returns (m, k) bool array
+    '''
+    t = np.asarray(theta)[:, None]
+    hi = np.asarray(angles, dtype=float)[None, :] + angles_std
+    lo = np.asarray(angles, dtype=float)[None, :] - angles_std
+    above_pi = (t <= hi - 2 * np.pi) | (t >= lo)
+    below_pi = (t >= 2 * np.pi + lo) | (t <= hi)
+    within_pi = (t <= hi) & (t >= lo)
+    return np.where(hi > np.pi, above_pi, np.where(lo < -np.pi, below_pi, within_pi))
+
+
+def get_missing_directions(neighbours, n_vectors, angles, angles_std, max_distance, kernel=np.inf):
+    '''Find expected directions in which vectors have no direct neighbour
+    A direction is missing its neighbour if there are neighbours in this
+    direction, but none of them is within `max_distance`.
+    All vectors and directions are evaluated at once.
+    neighbours: (i, j, distance, angle) arrays of neighbour pairs
+                (see VectorCollection.get_neighbours)
+    n_vectors: int number of vectors
+    angles: iter directions of expected neighbours
+    angles_std: half width of the angular window around those directions
+    max_distance: float of max eucl. distance in which we expect a neighbour
+    kernel: float only consider neighbour pairs up to this distance
+    returns vector idxs, angle idxs and distance of the closest neighbour
+    in that direction as (m,) arrays
+    '''
+    I, _, D, A = neighbours
+    ker = D <= kernel
+    pairs, dirs = np.nonzero(is_in_direction(A[ker], angles, angles_std))
+    I, D = I[ker][pairs], D[ker][pairs]
+
+    # closest neighbour in each direction, inf if there is none
+    closest = np.full((n_vectors, len(angles)), np.inf)
+    np.minimum.at(closest, (I, dirs), D)
+    idxs, angle_idxs = np.nonzero(np.isfinite(closest) & (closest > max_distance))
+    return idxs, angle_idxs, closest[idxs, angle_idxs]
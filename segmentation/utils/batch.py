@@ -0,0 +1,145 @@
+import importlib
+import json
+import os
+import time
+import matplotlib.pyplot as plt
+import utils.plot as plot
+from functools import partial
+from multiprocessing import Pool
+from skimage import io
+from utils.evaluation import Validation
+
+# registered procedures: name -> modules with a generate_segmentation()
+# function, the first gets the image, each following one the segmentation
+# of the previous one. Modules are imported by name inside the workers, so
+# this works with every multiprocessing start method.
+PROCEDURES = dict(
+    simple_thresholding=["simple_thresholding.procedure"],
+    local_thresholding=["local_thresholding.procedure"],
+    simple_gradient=["simple_gradient.procedure"],
+    double_gradient=["double_gradient.procedure"],
+    refine_segmentation=["simple_gradient.procedure", "refine_segmentation.procedure"],
+    refine_segmentation2=["simple_gradient.procedure", "refine_segmentation2.procedure"],
+    refine_lattice=["simple_gradient.procedure", "refine_lattice.procedure"],
+)
+
+
+def register(name, *modules):
+    """Register procedure `name` as chain of modules (see PROCEDURES)"""
+    PROCEDURES[name] = list(modules)
+
+
+def apply_procedure(procedure, img, params=None):
+    """Run procedure on image
+    procedure: name of registered procedure or list of modules
+    params: dict of module name -> dict of keyword arguments
+            for its generate_segmentation()
+    """
+    modules = PROCEDURES[procedure] if isinstance(procedure, str) else procedure
+    params = {} if params is None else params
+    out = img
+    for module in modules:
+        fn = importlib.import_module(module).generate_segmentation
+        out = fn(out, **params.get(module, {}))
+    return out
+
+
+def list_images(data_dir, exts=(".jpg", ".jpeg", ".png")):
+    """Get sorted image paths in directory (without label files)"""
+    return [
+        os.path.join(data_dir, d)
+        for d in sorted(os.listdir(data_dir))
+        if d.lower().endswith(exts) and not d.rsplit(".", 1)[0].endswith("_labels")
+    ]
+
+
+def labels_path(path):
+    """Get path of labels file for image (None if there is none)"""
+    labels = path.rsplit(".", 1)[0] + "_labels.png"
+    return labels if os.path.isfile(labels) else None
+
+
+def process(path, procedure, modules=None, params=None, transform=None, plot_dir=None):
+    """Segment and validate a single image, returns record of results
+    path: path to image file
+    procedure: name of registered procedure
+    modules: modules of procedure (looked up in PROCEDURES if None)
+    params: see apply_procedure()
+    transform: function applied to image before segmentation (e.g. cropping),
+               it must be importable by the workers. The labels image is
+               transformed the same way for validation.
+    plot_dir: if given, segmentation plots are saved there
+    """
+    if modules is None:
+        modules = PROCEDURES[procedure]
+    img = io.imread(path)
+    if transform is not None:
+        img = transform(img)
+    t0 = time.perf_counter()
+    seg = apply_procedure(modules, img, params)
+    t1 = time.perf_counter() - t0
+
+    name = os.path.basename(path)
+    rec = dict(img=name, procedure=procedure, time=t1, n=len(seg))
+    labels = labels_path(path)
+    if labels is not None:
+        if transform is not None:
+            labels = transform(io.imread(labels))
+            if labels.shape[:2] != img.shape[:2]:
+                raise ValueError(
+                    "transformed labels of %s do not match image shape %s" % (name, img.shape[:2]))
+        val = Validation(img, labels)
+        val.confuse(seg)
+        rec.update(TPR=val.TPR, PPV=val.PPV)
+    rec["segments"] = seg.ranges.tolist()
+
+    if plot_dir is not None:
+        plot.segmentation(
+            img, seg, title="%s %.2fs" % (name, t1), save=os.path.join(plot_dir, name)
+        )
+        plt.close("all")
+    return rec
+
+
+def run_batch(files, procedure, out_path, params=None, nproc=3, chunksize=1,
+              transform=None, plot_dir=None):
+    """Run procedure on images in parallel and stream results to JSON-lines
+    Each finished image is written as one line to `out_path` and yielded
+    right away (in order of completion), so nothing is collected in memory.
+    A record has img, procedure, time (s of segmentation), n (#segments),
+    TPR and PPV (if there is a labels file next to the image) and segments
+    (list of x0, x1, y0, y1).
+    files: list of image paths (see list_images())
+    procedure: name of registered procedure
+    out_path: path of JSON-lines file
+    params, transform, plot_dir: see process()
+    nproc: number of worker processes (1 runs in this process)
+    chunksize: number of images sent to a worker at once
+    """
+    fn = partial(
+        process,
+        procedure=procedure,
+        modules=PROCEDURES[procedure],
+        params=params,
+        transform=transform,
+        plot_dir=plot_dir,
+    )
+    with open(out_path, "w") as ouf:
+        if nproc == 1:
+            for rec in map(fn, files):
+                ouf.write(json.dumps(rec) + "\n")
+                ouf.flush()
+                yield rec
+            return
+        with Pool(nproc) as pool:
+            for rec in pool.imap_unordered(fn, files, chunksize=chunksize):
+                ouf.write(json.dumps(rec) + "\n")
+                ouf.flush()
+                yield rec
+
+
+def read_results(path):
+    """Iterate over records of JSON-lines file written by run_batch()"""
+    with open(path) as inf:
+        for line in inf:
+            yield json.loads(line)
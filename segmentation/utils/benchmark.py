@@ -0,0 +1,119 @@
+import gc
+import json
+import time
+import tracemalloc
+import numpy as np
+
+
+class Case(object):
+    """Benchmark case
+    name: str unique name, e.g. "consolidate_segments/5000"
+    setup: function returning the function to benchmark (called without
+           arguments), so inputs can be prepared (and copied if they are
+           modified) without being timed
+    repeat: int number of timed runs
+    """
+
+    def __init__(self, name, setup, repeat=5):
+        self.name = name
+        self.setup = setup
+        self.repeat = repeat
+
+    def __repr__(self):
+        return "<Case %s />" % self.name
+
+
+def measure(case, memory=True):
+    """Run a benchmark case
+    Time is measured with perf_counter, the peak memory allocated by python
+    and numpy with tracemalloc in an additional run (tracing slows it down).
+    returns record with name, time (min s), time_median (s), repeat
+    and peak (bytes, None if not measured)
+    """
+    times = []
+    for _ in range(case.repeat):
+        fn = case.setup()
+        gc.collect()
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+
+    peak = None
+    if memory:
+        fn = case.setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return dict(
+        name=case.name, time=min(times), time_median=float(np.median(times)),
+        repeat=case.repeat, peak=peak)
+
+
+def run(cases, memory=True, select=None):
+    """Measure cases one after another, records are yielded as they finish
+    select: only run cases whose name contains one of these strings
+    """
+    for case in cases:
+        if select and not any(s in case.name for s in select):
+            continue
+        yield measure(case, memory=memory)
+
+
+def compare(recs, baseline, tolerance=0.2, min_delta=0.02):
+    """Compare records with baseline records (matched by name)
+    Adds base_time, base_peak, time_ratio and peak_ratio (None if the case
+    is not in the baseline) and regression, which is True if time or peak
+    grew by more than `tolerance` (relative). Time differences below
+    `min_delta` seconds are considered noise.
+    returns list of records
+    """
+    base = {d["name"]: d for d in baseline}
+    out = []
+    for d in recs:
+        d = dict(d, base_time=None, base_peak=None, time_ratio=None,
+                 peak_ratio=None, regression=False)
+        b = base.get(d["name"])
+        if b is not None:
+            d["base_time"], d["base_peak"] = b["time"], b["peak"]
+            d["time_ratio"] = d["time"] / b["time"] if b["time"] > 0 else None
+            if d["peak"] is not None and b["peak"]:
+                d["peak_ratio"] = d["peak"] / b["peak"]
+            slower = d["time"] - b["time"] > max(tolerance * b["time"], min_delta)
+            larger = d["peak_ratio"] is not None and d["peak_ratio"] > 1 + tolerance
+            d["regression"] = bool(slower or larger)
+        out.append(d)
+    return out
+
+
+def format_table(recs):
+    """Format (compared) records as table"""
+
+    def fmt(value, pattern):
+        return "" if value is None else pattern % value
+
+    lines = ["case\ttime\tmedian\tpeak MB\tvs. base time\tvs. base peak"]
+    for d in recs:
+        line = "%s\t%.3fs\t%.3fs\t%s\t%s\t%s\t%s" % (
+            d["name"], d["time"], d["time_median"],
+            fmt(None if d["peak"] is None else d["peak"] / 1e6, "%.1f"),
+            fmt(d.get("time_ratio"), "x%.2f"), fmt(d.get("peak_ratio"), "x%.2f"),
+            "REGRESSION" if d.get("regression") else "")
+        lines.append(line.rstrip())
+    return "\n".join(lines)
+
+
+def write_results(recs, path):
+    """Write records to JSON file (e.g. as new baseline)"""
+    keys = ["name", "time", "time_median", "repeat", "peak"]
+    with open(path, "w") as ouf:
+        json.dump([{k: d[k] for k in keys} for d in recs], ouf, indent=1)
+
+
+def read_results(path):
+    """Read records written by write_results()"""
+    with open(path) as inf:
+        return json.load(inf)
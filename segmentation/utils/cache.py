@@ -0,0 +1,91 @@
+import hashlib
+import os
+import numpy as np
+
+# version of the file format, part of every file name
+FORMAT = 1
+
+
+def image_digest(img):
+    """Get hex digest of np image content (including shape and dtype)"""
+    h = hashlib.sha1()
+    h.update(("%s %s" % (img.shape, img.dtype)).encode())
+    h.update(np.ascontiguousarray(img).data)
+    return h.hexdigest()
+
+
+class ArrayCache(object):
+    """Content-addressed cache of np arrays on disk
+    Arrays are stored as .npy files named by the hash of their key and are
+    loaded memory-mapped copy-on-write (changes never reach the file).
+    Reading a file refreshes its mtime, when the cache grows beyond
+    `max_bytes` the least recently used files are removed.
+    Several processes can share one directory.
+    Keys should contain a version of the code computing the array
+    (see utils.preprocessing.VERSION), nothing is invalidated otherwise.
+    directory: path to cache directory (created if needed)
+    max_bytes: int size cap of all cached files
+    """
+
+    def __init__(self, directory, max_bytes=2e9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        name = hashlib.sha1(repr((FORMAT, key)).encode()).hexdigest()
+        return os.path.join(self.directory, name + ".npy")
+
+    def get(self, key):
+        """Get memory-mapped array for key or None if not cached"""
+        path = self._path(key)
+        try:
+            arr = np.load(path, mmap_mode="c")
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return arr
+
+    def put(self, key, arr):
+        """Store array under key and return it memory-mapped"""
+        path = self._path(key)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as ouf:
+            np.save(ouf, np.asarray(arr))
+        os.replace(tmp, path)
+        self.evict()
+        cached = self.get(key)
+        return np.asarray(arr) if cached is None else cached
+
+    def cached(self, key, fn):
+        """Get array for key, compute it with `fn()` and store it if missing"""
+        arr = self.get(key)
+        if arr is None:
+            arr = self.put(key, fn())
+        return arr
+
+    def evict(self):
+        """Remove least recently used files until cache fits into `max_bytes`"""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(d[1] for d in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove all cached files"""
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                os.remove(entry.path)
@@ -1,8 +1,28 @@
-import copy
 import numpy as np
-import utils.image as image
 from skimage import io, color, measure
-from utils.segmentation import Segment, Segmentation
+from utils.segmentation import Segmentation, overlapping_pairs
+
+
+def match_greedy(i, j):
+    """Match pairs (i[k], j[k]) one-to-one taking pairs in the given order
+    A pair is matched if neither its i nor its j was matched before.
+    returns bool mask of matched pairs
+    """
+    matched = np.zeros(len(i), dtype=bool)
+    # usually the first pair of each i has a distinct j already
+    first = np.ones(len(i), dtype=bool)
+    first[1:] = i[1:] != i[:-1]
+    if (np.diff(i) >= 0).all() and len(np.unique(j[first])) == first.sum():
+        return first
+
+    used_i, used_j = set(), set()
+    for k, (a, b) in enumerate(zip(i.tolist(), j.tolist())):
+        if a in used_i or b in used_j:
+            continue
+        used_i.add(a)
+        used_j.add(b)
+        matched[k] = True
+    return matched
 
 
 class Validation(object):
@@ -13,8 +33,11 @@ class Validation(object):
         self.truth = self.create_true_segmentation()
 
     def read_labels_file(self, path):
-        """Read w/ Gimp prepared labels-file as binary image"""
-        img = io.imread(path)
+        """Read w/ Gimp prepared labels-file as binary image
+        path: path of labels file or the labels image itself
+              (e.g. cropped like the image)
+        """
+        img = io.imread(path) if isinstance(path, str) else path
         gray = color.rgb2gray(img)
         th = (gray.max() - gray.min()) / 2
         gray[gray < th] = 0
@@ -22,42 +45,49 @@ class Validation(object):
         return measure.label(gray)
 
     def create_true_segmentation(self):
-        segments = Segmentation(img=self.img)
-        for region in measure.regionprops(self.labels):
-            segments.add(Segment.from_region(region, 1.2))
-        return segments
+        return Segmentation.from_labels(self.labels, img=self.img).expanded(1.2)
 
-    def confuse(self, segments):
-        TPs = []
-        FNs = list(range(len(self.truth)))
-        FPs = list(range(len(segments)))
+    def confuse(self, segments, iou=None):
+        """Match true segments with predicted segments one-to-one
+        By default each true segment (in order) is captured by the first
+        predicted segment which fully contains it and captured no other one.
+        With `iou` pairs with an IoU higher than `iou` are matched in order of
+        decreasing IoU instead.
+        Candidate pairs come from a KD-tree over segment centers, so only
+        close-by segments are compared.
+        returns TP, FN (indices of true segments), FP (of predicted segments)
+        """
+        truth = self.truth.ranges.astype(float)
+        pred = segments.ranges.astype(float)
+        t, p, In = overlapping_pairs(truth, pred)
+        if iou is None:
+            a, b = truth[t], pred[p]
+            inside = (
+                (b[:, 0] <= a[:, 0])
+                & (b[:, 1] >= a[:, 1])
+                & (b[:, 2] <= a[:, 2])
+                & (b[:, 3] >= a[:, 3])
+            )
+            t, p = t[inside], p[inside]
+            order = np.lexsort((p, t))
+        else:
+            Un = self.truth.areas[t] + segments.areas[p] - In
+            ious = In / Un
+            keep = ious > iou
+            t, p, ious = t[keep], p[keep], ious[keep]
+            order = np.lexsort((p, t, -ious))
+        matched = match_greedy(t[order], p[order])
+        self.matches = (t[order][matched], p[order][matched])
 
-        # check if true segments are within predicted segments
-        for idx_true in range(len(self.truth)):
-            seg_true = self.truth[idx_true]
-            captured = False
-            for idx_pred in range(len(segments)):
-                seg_pred = segments[idx_pred]
-                if (
-                    seg_pred.xrange[0] <= seg_true.xrange[0]
-                    and seg_pred.xrange[1] >= seg_true.xrange[1]
-                    and seg_pred.yrange[0] <= seg_true.yrange[0]
-                    and seg_pred.yrange[1] >= seg_true.yrange[1]
-                ):
-                    captured = True
-                    break
-            if captured:
-                FPs.remove(idx_pred)
-                TPs.append(idx_true)
-                FNs.remove(idx_true)
-        self.TPs = TPs
-        self.FNs = FNs
-        self.FPs = FPs
+        self.TPs = np.sort(self.matches[0])
+        self.FNs = np.setdiff1d(np.arange(len(self.truth)), self.TPs)
+        self.FPs = np.setdiff1d(np.arange(len(segments)), self.matches[1])
         nTPs = len(self.TPs)
         nFNs = len(self.FNs)
         nFPs = len(self.FPs)
         self.TPR = nTPs / (nTPs + nFNs) if nTPs + nFNs > 0 else np.nan
         self.PPV = nTPs / (nTPs + nFPs) if nTPs + nFPs > 0 else np.nan
+        return self.TPs, self.FNs, self.FPs
 
     def __repr__(self):
         info = "" if self.TPR is None else "TPR %.2f PPV %.2f" % (self.TPR, self.PPV)
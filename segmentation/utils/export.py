@@ -0,0 +1,167 @@
+import json
+import os
+import queue
+import threading
+import numpy as np
+from skimage import io
+from utils.segmentation import Segmentation
+
+
+def _grid(lo, hi, n, maxval):
+    """Source indices and weights for bilinear sampling of n px in [lo, hi)"""
+    pos = lo + (np.arange(n, dtype=np.float32) + 0.5) * ((hi - lo) / n) - 0.5
+    pos = np.clip(pos, 0, maxval - 1)
+    i0 = pos.astype(int)
+    i1 = np.minimum(i0 + 1, maxval - 1)
+    return i0, i1, pos - i0
+
+
+def extract_crops(img, segmentation, size=(150, 150)):
+    """Crop and resize all segments of an image into one tensor
+    Crops are sampled by bilinear interpolation on a `size` grid spanning
+    each segment, first along rows then along columns of the flattened
+    (rows, cols * channels) view of the segment. Segments reaching over the
+    image border are padded with border pixels.
+    img: np image (rows, cols[, channels])
+    segmentation: Segmentation of img
+    size: (rows, cols) of crops
+    returns uint8 array (n, rows, cols[, channels])
+    """
+    H, W = img.shape[:2]
+    C = img.shape[2] if img.ndim == 3 else 1
+    h, w = size
+    out = np.empty((len(segmentation), h, w * C), dtype=np.uint8)
+    channels = np.arange(C)
+    for k, (x0, x1, y0, y1) in enumerate(segmentation.ranges.astype(np.float32)):
+        c0, c1, fx = _grid(x0, x1, w, W)
+        r0, r1, fy = _grid(y0, y1, h, H)
+        top, left = r0[0], c0[0]
+        view = img[top : r1[-1] + 1, left : c1[-1] + 1].reshape(r1[-1] + 1 - top, -1)
+
+        # along rows
+        a = view[r0 - top].astype(np.float32)
+        b = view[r1 - top].astype(np.float32)
+        b -= a
+        b *= fy[:, None]
+        a += b
+
+        # along columns (of each channel)
+        c0 = ((c0 - left)[:, None] * C + channels).ravel()
+        c1 = ((c1 - left)[:, None] * C + channels).ravel()
+        crop = np.take(a, c0, axis=1)
+        d = np.take(a, c1, axis=1)
+        d -= crop
+        d *= np.repeat(fx, C)
+        crop += d
+        np.rint(crop, out=crop)
+        out[k] = crop
+    return out.reshape((len(segmentation), h, w) + img.shape[2:])
+
+
+def write_crops(out_dir, name, img, segmentation, size=(150, 150)):
+    """Write crops of all segments as one uint8 tensor `<name>.npy`
+    and append its entry to `index.jsonl` in `out_dir`
+    Each entry has img, file, size and segments (name, x0, x1, y0, y1),
+    crop i of the tensor belongs to segment i.
+    """
+    crops = extract_crops(img, segmentation, size=size)
+    np.save(os.path.join(out_dir, name + ".npy"), crops)
+    centroids = segmentation.centroids
+    rec = dict(
+        img=name,
+        file=name + ".npy",
+        size=list(size),
+        segments=[
+            ["%d-%d" % tuple(c)] + list(r)
+            for c, r in zip(centroids.tolist(), segmentation.ranges.tolist())
+        ],
+    )
+    with open(os.path.join(out_dir, "index.jsonl"), "a") as ouf:
+        ouf.write(json.dumps(rec) + "\n")
+
+
+def read_crops(out_dir):
+    """Iterate over (entry, crops) written to `out_dir`, crops are memory-mapped"""
+    with open(os.path.join(out_dir, "index.jsonl")) as inf:
+        for line in inf:
+            rec = json.loads(line)
+            yield rec, np.load(os.path.join(out_dir, rec["file"]), mmap_mode="r")
+
+
+def dump_crops(out_dir, target_dir):
+    """Write crops exported to `out_dir` as single images
+    `<target_dir>/<image name>/<segment name>.png`, e.g. to label them by hand
+    returns number of written crops
+    """
+    n = 0
+    for rec, crops in read_crops(out_dir):
+        img_dir = os.path.join(target_dir, rec["img"])
+        os.makedirs(img_dir, exist_ok=True)
+        for segment, crop in zip(rec["segments"], crops):
+            io.imsave(os.path.join(img_dir, segment[0] + ".png"), np.asarray(crop), check_contrast=False)
+            n += 1
+    return n
+
+
+class CropWriter(object):
+    """Writes segment crops in a background thread
+    Use as context manager: `write()` only queues an image and returns, so
+    reading, cropping and writing overlap with segmentation of the next
+    image. Errors of the writer are raised on the next `write()` or `close()`.
+    out_dir: directory for crop tensors and index
+    size: (rows, cols) of crops
+    transform: function applied to images given as path (e.g. cropping)
+    maxsize: max number of queued images
+    """
+
+    def __init__(self, out_dir, size=(150, 150), transform=None, maxsize=4):
+        self.out_dir = out_dir
+        self.size = size
+        self.transform = transform
+        self.queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.error = None
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            name, img, segmentation = item
+            try:
+                if isinstance(img, str):
+                    img = io.imread(img)
+                    if self.transform is not None:
+                        img = self.transform(img)
+                write_crops(self.out_dir, name, img, segmentation, size=self.size)
+            except Exception as e:
+                self.error = e
+
+    def _raise(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, name, img, segmentation):
+        """Queue crops of segmentation for writing
+        img: np image or path to image file
+        segmentation: Segmentation or array-like of x0, x1, y0, y1
+        """
+        self._raise()
+        if not isinstance(segmentation, Segmentation):
+            segmentation = Segmentation(np.asarray(segmentation).reshape(-1, 4))
+        self.queue.put((name, img, segmentation))
+
+    def close(self):
+        """Wait until all queued crops are written"""
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
@@ -0,0 +1,24 @@
+import numpy as np
+
+
+def union_find(n, i, j):
+    """Group nodes connected by edges with a vectorized disjoint-set
+    Roots are hooked onto the smaller root across every edge and paths are
+    compressed by pointer jumping until all edges lie within one set.
+    n: int number of nodes
+    i, j: int arrays of edges (i[k], j[k])
+    returns array of root per node, which is the smallest node in its group
+    """
+    parent = np.arange(n)
+    i = np.asarray(i, dtype=int)
+    j = np.asarray(j, dtype=int)
+    while True:
+        pi, pj = parent[i], parent[j]
+        if (pi == pj).all():
+            return parent
+        np.minimum.at(parent, np.maximum(pi, pj), np.minimum(pi, pj))
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
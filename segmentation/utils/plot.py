@@ -1,5 +1,6 @@
+import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
+from matplotlib.collections import LineCollection
 
 
 def image(img, cmap="gray", figsize=(20, 10)):
@@ -24,19 +25,20 @@ def segmentation(
     """Plots Image with segmentation as rectangles overlayed"""
     fig, ax = plt.subplots(figsize=figsize)
     ax.imshow(img)
-    for i in range(len(segmentation)):
-        s = segmentation[i]
-        s.calculate_properties()
-        cent = s.centroid
-        patch = mpatches.Rectangle(
-            (s.xrange[0], s.yrange[0]),
-            s.xdiam,
-            s.ydiam,
-            fill=False,
-            edgecolor=edgecolor,
-            linewidth=linewidth,
-        )
-        ax.add_patch(patch)
+    x0, x1, y0, y1 = segmentation.ranges.T
+    corners = np.stack(
+        [
+            np.stack([x0, y0], axis=1),
+            np.stack([x1, y0], axis=1),
+            np.stack([x1, y1], axis=1),
+            np.stack([x0, y1], axis=1),
+            np.stack([x0, y0], axis=1),
+        ],
+        axis=1,
+    )
+    ax.add_collection(
+        LineCollection(corners, colors=edgecolor, linewidths=linewidth)
+    )
     if title is not None:
         fig.suptitle(title, size=20)
     ax.set_axis_off()
@@ -0,0 +1,131 @@
+import numpy as np
+from scipy import ndimage
+from skimage.filters import rank
+from skimage.morphology import disk
+from utils.cache import image_digest
+
+# version of the preprocessing stages, part of all disk cache keys,
+# bump it when any stage changes so cached intermediates are recomputed
+VERSION = 2
+
+# luminance weights as in skimage.color.rgb2gray
+LUMA = np.array([0.2125, 0.7154, 0.0721], dtype=np.float32)
+
+
+def to_gray(img):
+    """Get float32 gray-scale image in [0, 255] from color or gray np image
+    Alpha channels are ignored, float images are expected in [0, 1].
+    """
+    if img.dtype.kind == "f":
+        img = img.astype(np.float32) * np.float32(255)
+    if img.ndim == 2:
+        return img.astype(np.float32)
+    return img[..., :3] @ LUMA
+
+
+def to_ubyte(img):
+    """Round and clip float image in [0, 255] to uint8"""
+    out = np.clip(img, 0, 255)
+    np.rint(out, out=out)
+    return out.astype(np.uint8)
+
+
+def stretch(img, percentiles=(2, 98)):
+    """Contrast stretching of image between 2 percentiles to uint8"""
+    lo, hi = np.percentile(img, percentiles).astype(np.float32)
+    out = (img - lo) * (np.float32(255) / max(hi - lo, np.float32(1e-6)))
+    return to_ubyte(out)
+
+
+def get_preprocessor(img, cache=None):
+    """Get Preprocessor for np image (or return it if already one)"""
+    return img if isinstance(img, Preprocessor) else Preprocessor(img, cache=cache)
+
+
+class Preprocessor(object):
+    """Computes and caches intermediate images of one image
+    Intermediates are uint8 (rank filters need that) or float32 and each
+    is computed at most once per set of parameters. Procedures accepting a
+    Preprocessor instead of an image therefore share common steps when run
+    on the same image. All intermediates are kept in `cache`.
+    Denoising is done by a median filter of size `median` and/or a gaussian
+    filter with sigma `sigma`, the other steps are based on its result.
+    With an `ArrayCache` intermediates are additionally stored on disk keyed
+    by the image digest and VERSION, so repeated runs on the same image skip
+    them.
+    img: color np image
+    cache: utils.cache.ArrayCache or None
+    """
+
+    def __init__(self, img, cache=None):
+        self.img = img
+        self.disk_cache = cache
+        self.cache = {}
+        self._digest = None
+
+    @property
+    def digest(self):
+        """hex digest of image content"""
+        if self._digest is None:
+            self._digest = image_digest(self.img)
+        return self._digest
+
+    def cached(self, key, fn):
+        """Get intermediate for key (tuple of stage name and parameters),
+        compute it with `fn()` if it is neither in memory nor on disk
+        Stages outside of this class should put their own version into
+        the key (e.g. LABELS_VERSION of procedures)."""
+        if key not in self.cache:
+            if self.disk_cache is None:
+                self.cache[key] = fn()
+            else:
+                self.cache[key] = self.disk_cache.cached((self.digest, VERSION) + key, fn)
+        return self.cache[key]
+
+    def gray(self):
+        """float32 gray-scale image in [0, 255]"""
+        return self.cached(("gray",), lambda: to_gray(self.img))
+
+    def gray_ubyte(self):
+        """uint8 gray-scale image"""
+        return self.cached(("gray_ubyte",), lambda: to_ubyte(self.gray()))
+
+    def denoised(self, median=None, sigma=None):
+        """median (uint8) and/or gaussian (float32) filtered gray-scale image"""
+
+        def fn():
+            if sigma is None:
+                if median is None:
+                    return self.gray_ubyte()
+                return rank.median(self.gray_ubyte(), disk(median))
+            src = self.gray() if median is None else self.denoised(median=median)
+            return ndimage.gaussian_filter(
+                src, sigma, output=np.float32, mode="nearest", truncate=4.0
+            )
+
+        return self.cached(("denoised", median, sigma), fn)
+
+    def stretched(self, median=None, sigma=None):
+        """uint8 denoised image contrast stretched between 2nd and 98th percentile"""
+        return self.cached(
+            ("stretched", median, sigma),
+            lambda: stretch(self.denoised(median=median, sigma=sigma)),
+        )
+
+    def gradient(self, mask, median=None, sigma=None):
+        """uint8 local gradient (max - min within disk) of stretched image"""
+        return self.cached(
+            ("gradient", mask, median, sigma),
+            lambda: rank.gradient(self.stretched(median=median, sigma=sigma), disk(mask)),
+        )
+
+    def equalized(self, radius, median=None, sigma=None):
+        """uint8 local histogram equalization of denoised image"""
+
+        def fn():
+            denoised = self.denoised(median=median, sigma=sigma)
+            if denoised.dtype != np.uint8:
+                denoised = to_ubyte(denoised)
+            return rank.equalize(denoised, disk(radius))
+
+        return self.cached(("equalized", radius, median, sigma), fn)
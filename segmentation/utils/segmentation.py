@@ -1,35 +1,108 @@
 import random
 import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.spatial import cKDTree
+from utils.graph import union_find
 
 
-def consolidate_segments(segments, overlap):
+def consolidate_segments(segments, overlap, method="greedy"):
     """Consolidate segmentation by relative overlap of segments
     A new segmentation is returned in which all `segments` of the original
     segmentation that have a relative overlap higher than `overlap` were
     averaged to a single segment each.
     relative overlap = intersection area / union area
+    method: 'greedy' walks through segments in order and averages each with
+            all following segments it overlaps with (original behaviour),
+            'union' averages whole groups of transitively overlapping segments
     """
-    D = segments.get_overlap_matrix()
-    out = Segmentation(img=segments.img)
-    rmvd = []
+    D = segments.get_sparse_overlap_matrix()
+    D.data[~(D.data > overlap)] = 0
+    D.eliminate_zeros()
+
+    if method == "union":
+        return _consolidate_groups(segments, D)
+    if method != "greedy":
+        raise ValueError("method must be greedy or union")
+
+    rmvd = np.zeros(len(segments), dtype=bool)
+    grps = []
     for i in range(len(segments)):
-        if i in rmvd:
+        if rmvd[i]:
             continue
-        idxs = list(np.where(D[i] > overlap)[0])
-        n = len(idxs)
-        if n > 0:
-            rmvd = rmvd + idxs
-            xranges = np.ndarray((n, 2))
-            yranges = np.ndarray((n, 2))
-            for j, idx in enumerate(idxs):
-                sim_seg = segments[idx]
-                xranges[j] = sim_seg.xrange
-                yranges[j] = sim_seg.yrange
-            out.add(Segment(xrange=xranges.mean(axis=0), yrange=yranges.mean(axis=0)))
+        idxs = D.indices[D.indptr[i] : D.indptr[i + 1]]
+        if len(idxs) > 0:
+            rmvd[idxs] = True
+            grps.append(idxs)
+
+    out = Segmentation(img=segments.img)
+    if len(grps) > 0:
+        sizes = np.array([len(d) for d in grps])
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        ranges = segments.ranges[np.concatenate(grps)].astype(float)
+        out.add_many(np.add.reduceat(ranges, starts, axis=0) / sizes[:, None])
+    return out
 
+
+def _consolidate_groups(segments, D):
+    """Average connected components of overlap matrix `D` in one pass"""
+    D = D.tocoo()
+    roots = union_find(len(segments), D.row, D.col)
+
+    # segments without any entry (not even on the diagonal) are dropped
+    used = np.zeros(len(segments), dtype=bool)
+    used[D.row] = True
+    grps, labels = np.unique(roots[used], return_inverse=True)
+    sizes = np.bincount(labels, minlength=len(grps))
+    ranges = segments.ranges[used].astype(float)
+    sums = np.stack(
+        [np.bincount(labels, ranges[:, k], minlength=len(grps)) for k in range(4)],
+        axis=1,
+    )
+
+    out = Segmentation(img=segments.img)
+    out.add_many(sums / sizes[:, None])
     return out
 
 
+def overlapping_pairs(ranges_a, ranges_b=None):
+    """Find all pairs of boxes with a positive intersection
+    Candidates are queried from a KD-tree over box centers using the
+    chebyshev distance, so only close-by boxes are ever compared.
+    ranges_a, ranges_b: (n, 4) arrays of x0, x1, y0, y1
+    if `ranges_b` is None pairs within `ranges_a` are returned with i < j
+    returns (i, j, intersection area) arrays
+    """
+    ranges_a = np.asarray(ranges_a, dtype=float)
+    ranges_b = ranges_a if ranges_b is None else np.asarray(ranges_b, dtype=float)
+    if len(ranges_a) == 0 or len(ranges_b) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+    def centers(r):
+        return np.stack([r[:, 0] + r[:, 1], r[:, 2] + r[:, 3]], axis=1) / 2
+
+    def max_diam(r):
+        return max((r[:, 1] - r[:, 0]).max(), (r[:, 3] - r[:, 2]).max())
+
+    radius = (max_diam(ranges_a) + max_diam(ranges_b)) / 2
+    tree_a = cKDTree(centers(ranges_a))
+    if ranges_b is ranges_a:
+        pairs = tree_a.query_pairs(radius, p=np.inf, output_type="ndarray")
+    else:
+        tree_b = cKDTree(centers(ranges_b))
+        pairs = tree_a.sparse_distance_matrix(
+            tree_b, radius, p=np.inf, output_type="ndarray"
+        )
+        pairs = np.stack([pairs["i"], pairs["j"]], axis=1)
+    i, j = pairs[:, 0], pairs[:, 1]
+
+    a, b = ranges_a[i], ranges_b[j]
+    Xin = np.minimum(a[:, 1], b[:, 1]) - np.maximum(a[:, 0], b[:, 0])
+    Yin = np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 2], b[:, 2])
+    keep = (Xin > 0) & (Yin > 0)
+    return i[keep], j[keep], Xin[keep] * Yin[keep]
+
+
 class Segment(object):
     """
     centroid: (row, col) of centroid
@@ -90,46 +163,161 @@ class Segment(object):
 
 
 class Segmentation(object):
-    """Combines collection of Segments"""
+    """Combines collection of Segments
+    Segments are stored column-wise in a single (n, 4) int32 array with
+    columns x0, x1, y0, y1 (see `ranges`). Indexing with an int returns a
+    Segment view of that row, indexing with a slice, index array or bool mask
+    returns a new Segmentation.
+    segments: list of Segments or array-like of shape (n, 4)
+    img: image from which segments were extracted
+    """
 
     def __init__(self, segments=None, img=None):
-        if segments is None:
-            self.segments = []
-        else:
-            self.segments = segments
+        self._ranges = np.empty((0, 4), dtype=np.int32)
+        self._n = 0
         self.img = img
+        if segments is not None:
+            if isinstance(segments, (Segmentation, np.ndarray)):
+                self.add_many(segments)
+            else:
+                self.add_many([s.xrange + s.yrange for s in segments])
 
     def __getitem__(self, idx):
-        return self.segments[idx]
+        if isinstance(idx, (int, np.integer)):
+            x0, x1, y0, y1 = self.ranges[idx]
+            return Segment(xrange=(x0, x1), yrange=(y0, y1))
+        return Segmentation(self.ranges[idx], img=self.img)
 
     def __len__(self):
-        return len(self.segments)
+        return self._n
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
     def __repr__(self):
-        ars = []
-        diams = []
-        areas = []
-        for d in self.segments:
-            d.calculate_properties()
-            ars.append(d.ar)
-            diams.append(d.xdiam)
-            diams.append(d.ydiam)
-            areas.append(d.area)
         info = ""
         if len(self) > 0:
+            diams = self.diams.ravel()
+            ars = self.ars
+            areas = self.areas
             info = (
                 "\n\tMin\tMean\tMed\tMax"
                 + "\n Diams\t%d\t%.1f\t%.1f\t%d"
-                % (min(diams), np.mean(diams), np.median(diams), max(diams))
+                % (diams.min(), diams.mean(), np.median(diams), diams.max())
                 + "\n ARs\t%.1f\t%.1f\t%.1f\t%.1f"
-                % (min(ars), np.mean(ars), np.median(ars), max(ars))
+                % (ars.min(), ars.mean(), np.median(ars), ars.max())
                 + "\n Areas\t%d\t%.1f\t%.1f\t%d"
-                % (min(areas), np.mean(areas), np.median(areas), max(areas))
+                % (areas.min(), areas.mean(), np.median(areas), areas.max())
             )
         return "<Segmentation %d segments" % len(self) + info + " />"
 
+    @property
+    def ranges(self):
+        """(n, 4) int32 array of x0, x1, y0, y1"""
+        return self._ranges[: self._n]
+
+    @property
+    def xranges(self):
+        """(n, 2) array of x0, x1"""
+        return self.ranges[:, :2]
+
+    @property
+    def yranges(self):
+        """(n, 2) array of y0, y1"""
+        return self.ranges[:, 2:]
+
+    @property
+    def centroids(self):
+        """(n, 2) int array of centroids (row, col)"""
+        r = self.ranges.astype(float)
+        rows = (r[:, 2] + r[:, 3]) / 2
+        cols = (r[:, 0] + r[:, 1]) / 2
+        return np.stack([rows, cols], axis=1).astype(int)
+
+    @property
+    def diams(self):
+        """(n, 2) int array of diameters (xdiam, ydiam)"""
+        r = self.ranges
+        return np.stack([r[:, 1] - r[:, 0], r[:, 3] - r[:, 2]], axis=1)
+
+    @property
+    def areas(self):
+        """(n,) int array of areas"""
+        diams = self.diams
+        return diams[:, 0] * diams[:, 1]
+
+    @property
+    def ars(self):
+        """(n,) float array of aspect ratios (xdiam / ydiam)"""
+        diams = self.diams
+        return diams[:, 0] / diams[:, 1]
+
+    @property
+    def ars_max(self):
+        """(n,) float array of max aspect ratios (always >= 1)"""
+        diams = self.diams
+        return diams.max(axis=1) / diams.min(axis=1)
+
+    @staticmethod
+    def from_labels(labels, img=None):
+        """Get segmentation of the bounding boxes of all labeled regions at once
+        Segments are in order of labels like from regionprops().
+        labels: int label image as from skimage.measure.label()
+        """
+        slices = [d for d in ndimage.find_objects(labels) if d is not None]
+        ranges = np.array(
+            [(c.start, c.stop, r.start, r.stop) for r, c in slices], dtype=np.int32
+        )
+        return Segmentation(ranges.reshape(-1, 4), img=img)
+
+    def expanded(self, expand=1.2):
+        """Get new segmentation with all segments expanded around their center
+        like Segment.from_region()
+        expand: factor by which to expand the bounding boxes
+        """
+        r = self.ranges.astype(float)
+        factor = (expand - 1) / 2
+        xpad = (r[:, 1] - r[:, 0]) * factor
+        ypad = (r[:, 3] - r[:, 2]) * factor
+        return Segmentation(r + np.stack([-xpad, xpad, -ypad, ypad], axis=1), img=self.img)
+
+    def fits(self, diam_range=None, area_range=None, max_ar=None):
+        """Get bool mask of segments which fit into defined space
+        All limits are exclusive, None means no limit.
+        diam_range: min and max diam allowed
+        area_range: min and max area allowed
+        max_ar: maximum aspect ratio allowed
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if diam_range is not None:
+            diams = self.diams
+            mask &= (diams.min(axis=1) > diam_range[0]) & (diams.max(axis=1) < diam_range[1])
+        if area_range is not None:
+            areas = self.areas
+            mask &= (areas > area_range[0]) & (areas < area_range[1])
+        if max_ar is not None:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                mask &= self.ars_max < max_ar
+        return mask
+
     def add(self, segment):
-        self.segments.append(segment)
+        self.add_many([segment.xrange + segment.yrange])
+
+    def add_many(self, ranges):
+        """Add segments in bulk
+        ranges: Segmentation or array-like of shape (n, 4) with x0, x1, y0, y1
+        """
+        if isinstance(ranges, Segmentation):
+            ranges = ranges.ranges
+        ranges = np.asarray(ranges, dtype=float).reshape(-1, 4).astype(np.int32)
+        n = self._n + len(ranges)
+        if n > len(self._ranges):
+            buffer = np.empty((max(n, 2 * len(self._ranges)), 4), dtype=np.int32)
+            buffer[: self._n] = self.ranges
+            self._ranges = buffer
+        self._ranges[self._n : n] = ranges
+        self._n = n
 
     def get_img(self, segment):
         """crop img for segment"""
@@ -144,24 +332,36 @@ class Segmentation(object):
                      0, 1, d],
                      0, 0, 1]]
         """
-        n = len(self)
-        xranges = np.ndarray((n, 2))
-        yranges = np.ndarray((n, 2))
-        for i in range(n):
-            s = self[i]
-            xranges[i] = s.xrange
-            yranges[i] = s.yrange
-
-        X0 = np.stack(np.meshgrid(xranges[:, 0], xranges[:, 0]), axis=2)
-        X1 = np.stack(np.meshgrid(xranges[:, 1], xranges[:, 1]), axis=2)
-        Y0 = np.stack(np.meshgrid(yranges[:, 0], yranges[:, 0]), axis=2)
-        Y1 = np.stack(np.meshgrid(yranges[:, 1], yranges[:, 1]), axis=2)
-        A = (xranges[:, [1]] - xranges[:, [0]]) * (yranges[:, [1]] - yranges[:, [0]])
-
-        Xin = np.min(X1, axis=-1) - np.max(X0, axis=-1)
-        Yin = np.min(Y1, axis=-1) - np.max(Y0, axis=-1)
+        r = self.ranges.astype(float)
+        x0, x1, y0, y1 = r[:, [0]], r[:, [1]], r[:, [2]], r[:, [3]]
+        A = (x1 - x0) * (y1 - y0)
+
+        Xin = np.minimum(x1, x1.T) - np.maximum(x0, x0.T)
+        Yin = np.minimum(y1, y1.T) - np.maximum(y0, y0.T)
         Xin[Xin < 0] = 0
         Yin[Yin < 0] = 0
         In = Xin * Yin
         Un = A.T + A - In
         return np.triu(In / Un)
+
+    def get_sparse_overlap_matrix(self):
+        """Get overlap matrix like `get_overlap_matrix` as sparse CSR matrix
+        Only pairs of segments which actually intersect are stored,
+        so memory grows linearly with the number of segments.
+        triu form including the diagonal
+        """
+        n = len(self)
+        r = self.ranges.astype(float)
+        A = (r[:, 1] - r[:, 0]) * (r[:, 3] - r[:, 2])
+        i, j, In = overlapping_pairs(r)
+        Un = A[i] + A[j] - In
+
+        diag = np.arange(n)
+        with np.errstate(invalid="ignore"):
+            data = np.concatenate([A / A, In / Un])
+        D = coo_matrix(
+            (data, (np.concatenate([diag, i]), np.concatenate([diag, j]))),
+            shape=(n, n),
+        ).tocsr()
+        D.sort_indices()
+        return D
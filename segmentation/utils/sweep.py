@@ -0,0 +1,201 @@
+import itertools
+import json
+import random
+import time
+import numpy as np
+from multiprocessing import Pool
+from skimage import io
+from utils.batch import PROCEDURES, apply_procedure, labels_path
+from utils.cache import ArrayCache
+from utils.evaluation import Validation
+from utils.preprocessing import Preprocessor
+
+# images, validations and preprocessors loaded by a worker
+_images = {}
+_cache = None
+
+
+def expand_space(space):
+    """Get all parameter combinations of a search space
+    space: dict of module name -> dict of parameter name -> list of values
+    returns list of params as for utils.batch.apply_procedure()
+    """
+    keys = [(m, k) for m, d in space.items() for k in d]
+    configs = []
+    for values in itertools.product(*[space[m][k] for m, k in keys]):
+        params = {m: {} for m in space}
+        for (m, k), v in zip(keys, values):
+            params[m][k] = v
+        configs.append(params)
+    return configs
+
+
+def f1(TPR, PPV):
+    """harmonic mean of TPR and PPV"""
+    return 2 * TPR * PPV / (TPR + PPV) if TPR + PPV > 0 else 0.0
+
+
+def pareto_front(points):
+    """Get bool mask of points which are not dominated by any other point
+    points: (n, d) array, all columns are maximized
+    """
+    P = np.asarray(points, dtype=float).reshape(len(points), -1)
+    ge = (P[None, :, :] >= P[:, None, :]).all(axis=2)
+    gt = (P[None, :, :] > P[:, None, :]).any(axis=2)
+    return ~(ge & gt).any(axis=1)
+
+
+def pareto_layers(points):
+    """Get Pareto layer of each point by non-dominated sorting
+    Layer 0 is the Pareto front, layer 1 the front without layer 0 and so on.
+    points: (n, d) array, all columns are maximized
+    returns (n,) int array
+    """
+    P = np.asarray(points, dtype=float).reshape(len(points), -1)
+    layers = np.full(len(P), -1)
+    left = np.arange(len(P))
+    layer = 0
+    while len(left) > 0:
+        front = pareto_front(P[left])
+        layers[left[front]] = layer
+        left = left[~front]
+        layer += 1
+    return layers
+
+
+def prune(points, n_keep):
+    """Select points to keep by Pareto layers
+    The whole front is always kept, further layers fill up to `n_keep`,
+    within a layer points are taken in order of the first column.
+    points: (n, d) array, all columns are maximized
+    returns sorted indices of kept points
+    """
+    P = np.asarray(points, dtype=float).reshape(len(points), -1)
+    layers = pareto_layers(P)
+    order = np.lexsort((-P[:, 0], layers))
+    n_keep = max(n_keep, (layers == 0).sum())
+    return np.sort(order[:n_keep])
+
+
+def _init(cache_dir, max_bytes):
+    global _cache
+    _cache = None if cache_dir is None else ArrayCache(cache_dir, max_bytes)
+
+
+def _load(path):
+    if path not in _images:
+        img = io.imread(path)
+        _images[path] = (img, Validation(img, labels_path(path)), Preprocessor(img, cache=_cache))
+    return _images[path]
+
+
+def evaluate(job):
+    """Run one configuration on one image
+    job: (config index, modules, params, image path, shared) where shared
+         means the worker's cached preprocessing of the image is reused
+    returns config index, image path, TPR, PPV, time (s)
+    """
+    k, modules, params, path, shared = job
+    img, val, pre = _load(path)
+    if not shared:
+        pre = Preprocessor(img)
+    t0 = time.perf_counter()
+    seg = apply_procedure(modules, pre, params)
+    t1 = time.perf_counter() - t0
+    val.confuse(seg)
+    return k, path, val.TPR, val.PPV, t1
+
+
+def sweep(files, procedure, space, nproc=3, eta=3, min_images=1, chunksize=1,
+          cache_dir="data/cache/", max_bytes=2e9, seed=0):
+    """Explore parameter space of a procedure by successive halving on images
+    All configurations are evaluated on `min_images` labeled images, then
+    only 1/`eta` of them are evaluated on `eta` times as many images and so
+    on until the survivors saw all images. Configurations are kept by Pareto
+    layers of F1 (of mean TPR and PPV) and time (see prune()), so fast
+    configurations with a lower F1 are not dropped before time counts.
+    Preprocessing is reused across configurations where their parameters
+    agree (in memory per worker and in the ArrayCache in `cache_dir`).
+    As cached stages distort timings, the first new image of a configuration
+    in each round is run with fresh preprocessing and timed, survivors are
+    timed once more on all images with fresh preprocessing.
+    files: paths of images with labels files (see utils.batch.list_images())
+    procedure: name of registered procedure (see utils.batch.PROCEDURES)
+    space: search space (see expand_space())
+    nproc: number of worker processes
+    chunksize: number of jobs sent to a worker at once
+    seed: seed for the order in which images are used
+    returns list of records with params, images (#images evaluated on), TPR,
+    PPV, F1, time (mean s per image of timed runs) and pareto
+    (whether survivor is on the Pareto front of F1 and time)
+    """
+    configs = expand_space(space)
+    modules = PROCEDURES[procedure]
+    files = list(files)
+    random.Random(seed).shuffle(files)
+    scores = [dict() for _ in configs]
+    times = [[] for _ in configs]
+
+    def mean_scores(k):
+        TPR, PPV = np.array(list(scores[k].values())).reshape(-1, 2).mean(axis=0)
+        return TPR, PPV
+
+    alive = list(range(len(configs)))
+    n = min_images
+    with Pool(nproc, initializer=_init, initargs=(cache_dir, max_bytes)) as pool:
+        while True:
+            n = min(n, len(files))
+            # first new image of each configuration without shared preprocessing
+            jobs = []
+            for k in alive:
+                new = [path for path in files[:n] if path not in scores[k]]
+                jobs += [(k, modules, configs[k], path, i > 0) for i, path in enumerate(new)]
+            timed = {(k, path) for k, _, _, path, shared in jobs if not shared}
+            for k, path, TPR, PPV, t in pool.imap_unordered(evaluate, jobs, chunksize):
+                scores[k][path] = (TPR, PPV)
+                if (k, path) in timed:
+                    times[k].append(t)
+            if n == len(files):
+                break
+            alive = [alive[i] for i in prune(
+                [(f1(*mean_scores(k)), -np.mean(times[k])) for k in alive],
+                max(len(alive) // eta, 1))]
+            n *= eta
+
+        survivors = [(k, modules, configs[k], path, False) for k in alive for path in files]
+        for k in alive:
+            times[k] = []
+        for k, _, _, _, t in pool.imap_unordered(evaluate, survivors, chunksize):
+            times[k].append(t)
+
+    recs = []
+    for k, params in enumerate(configs):
+        TPR, PPV = mean_scores(k)
+        recs.append(dict(
+            params=params, images=len(scores[k]), TPR=TPR, PPV=PPV, F1=f1(TPR, PPV),
+            time=np.mean(times[k]) if times[k] else None, pareto=False))
+    final = [recs[k] for k in alive]
+    front = pareto_front([(d["F1"], -d["time"]) for d in final])
+    for d, p in zip(final, front):
+        d["pareto"] = bool(p)
+    return recs
+
+
+def format_table(recs, top=None):
+    """Format records of sweep() as table, Pareto front first then by F1"""
+    recs = sorted(recs, key=lambda d: (not d["pareto"], d["time"] is None, -d["F1"]))
+    if top is not None:
+        recs = recs[:top]
+    lines = ["pareto\timages\tTPR\tPPV\tF1\ttime\tparams"]
+    for d in recs:
+        params = {k: v for m in d["params"].values() for k, v in m.items()}
+        lines.append("%s\t%d\t%.3f\t%.3f\t%.3f\t%s\t%s" % (
+            "*" if d["pareto"] else "", d["images"], d["TPR"], d["PPV"], d["F1"],
+            "" if d["time"] is None else "%.2fs" % d["time"], params))
+    return "\n".join(lines)
+
+
+def write_results(recs, path):
+    """Write records of sweep() to JSON file"""
+    with open(path, "w") as ouf:
+        json.dump(recs, ouf, indent=1)
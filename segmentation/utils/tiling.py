@@ -0,0 +1,64 @@
+import numpy as np
+from utils.segmentation import Segmentation, consolidate_segments
+
+
+def get_tiles(shape, tile_size, halo):
+    """Split image shape into tiles with overlapping borders
+    Tile cores partition the image, each tile is its core extended by
+    `halo` px on every side (clipped to the image).
+    shape: (rows, cols) of image
+    tile_size: int edge length of tile cores in px
+    halo: int px by which tiles overlap their core
+    returns list of (core, tile) with (y0, y1, x0, x1) each
+    """
+    tiles = []
+    for y0 in range(0, shape[0], tile_size):
+        for x0 in range(0, shape[1], tile_size):
+            y1 = min(y0 + tile_size, shape[0])
+            x1 = min(x0 + tile_size, shape[1])
+            core = (y0, y1, x0, x1)
+            tile = (
+                max(y0 - halo, 0),
+                min(y1 + halo, shape[0]),
+                max(x0 - halo, 0),
+                min(x1 + halo, shape[1]),
+            )
+            tiles.append((core, tile))
+    return tiles
+
+
+def generate_segmentation(img, procedure, diam_range=(150, 300), tile_size=None, max_overlap=0.5):
+    """Create Segmentation by running a segmentation procedure tile by tile
+    Tiles overlap by the max cell diameter, so every cell lies completely
+    within at least one tile. Of each tile only segments with their centroid
+    in the tile's core are kept. Segments captured twice along the seams
+    are consolidated afterwards. Peak memory is bounded by the tile size.
+    Note that image statistics (percentiles, Otsu thresholds) are computed
+    per tile.
+    img: color np image
+    procedure: callable creating a Segmentation from an image, e.g.
+               functools.partial(simple_gradient.procedure.generate_segmentation,
+                                 diam_range=(60, 150))
+    diam_range: min, max diam of cells in px
+    tile_size: int edge length of tile cores in px (default 8x max diam)
+    max_overlap: float of maximum relative overlap 2 segments can have
+    """
+    halo = int(diam_range[1])
+    if tile_size is None:
+        tile_size = 8 * halo
+
+    seg = Segmentation(img=img)
+    for core, tile in get_tiles(img.shape[:2], tile_size, halo):
+        y0, y1, x0, x1 = tile
+        tile_seg = procedure(img[y0:y1, x0:x1])
+        if len(tile_seg) == 0:
+            continue
+        ranges = tile_seg.ranges + np.array([x0, x0, y0, y0], dtype=np.int32)
+        rows = (ranges[:, 2] + ranges[:, 3]) / 2
+        cols = (ranges[:, 0] + ranges[:, 1]) / 2
+        in_core = (
+            (rows >= core[0]) & (rows < core[1]) & (cols >= core[2]) & (cols < core[3])
+        )
+        seg.add_many(ranges[in_core])
+
+    return consolidate_segments(seg, overlap=max_overlap)
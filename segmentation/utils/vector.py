@@ -1,26 +1,27 @@
 import numpy as np
-from sklearn.cluster import DBSCAN
+from scipy.spatial import cKDTree
+from utils.graph import union_find
 
 
 def consolidate_vectors(vectors, eps):
-    """Consolidate vectors which are close (eucl.) using DBSCAN
+    """Consolidate vectors which are close (eucl.) by merging them
+    Vectors within `eps` of each other are grouped transitively (like DBSCAN
+    with min_samples=1) using KD-tree pairs and a disjoint-set.
+    Groups are ordered by their first vector.
     vectors: VectorCollection with vectors to be consolidated
-    eps: epsilon for DBSCAN (eucl.), how close to be the same grp
+    eps: max eucl. distance of two vectors to be in the same grp
+    returns VectorCollection of group centroids
     """
     if len(vectors) < 1:
-        return []
-    coords = np.array([(v.y, v.x) for v in vectors])
-    labels = DBSCAN(eps=eps, min_samples=1).fit(coords).labels_
+        return VectorCollection()
+    pairs = cKDTree(vectors.coords).query_pairs(eps, output_type="ndarray")
+    roots = union_find(len(vectors), pairs[:, 0], pairs[:, 1])
 
-    label2idxs = {label: [] for label in set(labels)}
-    for i, d in enumerate(labels):
-        label2idxs[d].append(i)
-
-    consolidated_vectors = VectorCollection()
-    for d in label2idxs:
-        centroid = coords[label2idxs[d]].mean(axis=0)
-        consolidated_vectors.add(Vector(centroid[1], centroid[0]))
-    return consolidated_vectors
+    _, labels = np.unique(roots, return_inverse=True)
+    counts = np.bincount(labels)
+    x = np.bincount(labels, vectors.x) / counts
+    y = np.bincount(labels, vectors.y) / counts
+    return VectorCollection.from_array(np.stack([x, y], axis=1))
 
 
 class Vector(object):
@@ -45,7 +46,7 @@ class Vector(object):
         )
 
     def len(self):
-        return abs(np.complex(self.x, self.y))
+        return abs(complex(self.x, self.y))
 
     def get_theta(self):
         return np.arctan2(self.y, self.x)
@@ -59,25 +60,119 @@ class Vector(object):
 
 
 class VectorCollection(object):
-    """Combines a collection of vectors"""
+    """Combines a collection of vectors
+    Vectors are stored in a single (n, 2) float64 array of x, y.
+    Indexing with an int returns a Vector of that row, indexing with a slice,
+    index array or bool mask returns a new VectorCollection.
+    Adding or subtracting a Vector, a VectorCollection of same length or an
+    (n, 2) array works element-wise.
+    vectors: list of Vectors or array-like of shape (n, 2)
+    """
 
     def __init__(self, vectors=None):
-        if vectors is None:
-            self.vectors = []
-        else:
-            self.vectors = vectors
+        self._coords = np.empty((0, 2))
+        self._n = 0
+        self._tree = None
+        if vectors is not None:
+            if isinstance(vectors, (VectorCollection, np.ndarray)):
+                self.add_many(vectors)
+            else:
+                self.add_many([(v.x, v.y) for v in vectors])
 
     def __len__(self):
-        return len(self.vectors)
+        return self._n
 
     def __getitem__(self, idx):
-        return self.vectors[idx]
+        if isinstance(idx, (int, np.integer)):
+            x, y = self.coords[idx]
+            return Vector(x, y)
+        return VectorCollection(self.coords[idx])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
     def __repr__(self):
-        return "<VectorCollection %d vectors />" % len(self.vectors)
+        return "<VectorCollection %d vectors />" % len(self)
+
+    def __add__(self, o):
+        return VectorCollection(self.coords + VectorCollection._as_array(o))
+
+    def __sub__(self, o):
+        return VectorCollection(self.coords - VectorCollection._as_array(o))
+
+    @staticmethod
+    def _as_array(o):
+        if isinstance(o, Vector):
+            return np.array([o.x, o.y])
+        if isinstance(o, VectorCollection):
+            return o.coords
+        return np.asarray(o, dtype=float)
+
+    @staticmethod
+    def from_array(coords):
+        """Create VectorCollection from (n, 2) array of x, y"""
+        return VectorCollection(np.asarray(coords, dtype=float))
+
+    @staticmethod
+    def concatenate(collections):
+        """Concatenate VectorCollections into a new one"""
+        out = VectorCollection()
+        for d in collections:
+            out.add_many(d)
+        return out
+
+    @property
+    def coords(self):
+        """(n, 2) array of x, y"""
+        return self._coords[: self._n]
+
+    @property
+    def x(self):
+        return self.coords[:, 0]
+
+    @property
+    def y(self):
+        return self.coords[:, 1]
+
+    @property
+    def tree(self):
+        """cKDTree of coords, built once and shared by neighbour queries
+        (rebuilt after add_many, coords must not be changed in place)"""
+        if self._tree is None:
+            self._tree = cKDTree(self.coords)
+        return self._tree
+
+    def to_array(self):
+        """Get copy of (n, 2) array of x, y"""
+        return self.coords.copy()
 
     def add(self, vector):
-        self.vectors.append(vector)
+        self.add_many([(vector.x, vector.y)])
+
+    def add_many(self, coords):
+        """Add vectors in bulk
+        coords: VectorCollection or array-like of shape (n, 2) with x, y
+        """
+        if isinstance(coords, VectorCollection):
+            coords = coords.coords
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        n = self._n + len(coords)
+        if n > len(self._coords):
+            buffer = np.empty((max(n, 2 * len(self._coords)), 2))
+            buffer[: self._n] = self.coords
+            self._coords = buffer
+        self._coords[self._n : n] = coords
+        self._n = n
+        self._tree = None
+
+    def len(self):
+        """Get (n,) array of vector lengths"""
+        return np.hypot(self.x, self.y)
+
+    def get_theta(self):
+        """Get (n,) array of radian angles"""
+        return np.arctan2(self.y, self.x)
 
     def get_distance_matrix(self):
         """Calculate euclid. distance matrix for VectorCollection
@@ -85,8 +180,7 @@ class VectorCollection(object):
                      [0, 0, d],
                      [0, 0, 0]])
         """
-        x = [(d.x, d.y) for d in self.vectors]
-        z = np.array([[complex(d[1], d[0]) for d in x]])
+        z = (self.y + 1j * self.x)[None, :]
         return np.triu(abs(z.T - z))
 
     def get_angle_matrix(self):
@@ -95,11 +189,70 @@ class VectorCollection(object):
                      [t, 0, t],
                      [t, t, 0]])
         """
-        n = len(self)
-        X = np.ndarray((n, 1))
-        Y = np.ndarray((n, 1))
-        for i in range(n):
-            v = self[i]
-            X[i, 0] = v.x
-            Y[i, 0] = v.y
+        X = self.x[:, None]
+        Y = self.y[:, None]
         return np.arctan2(Y.T - Y, X.T - X)
+
+    def get_neighbours(self, max_distance, symmetric=False, idxs=None):
+        """Get pairs of vectors within `max_distance` using a KD-tree
+        Pairs (i, j) with i < j are sorted by i, then j. Distances and angles
+        equal the corresponding entries of `get_distance_matrix` and
+        `get_angle_matrix`. Pairs at distance 0 are excluded.
+        symmetric: also return every pair as (j, i), then sorted by i, then j
+        idxs: only return pairs with i in `idxs` (default all vectors)
+        returns (i, j, distance, radian angle from i to j) arrays
+        """
+        coords = self.coords
+        tree = self.tree
+        # query slightly larger radius, then filter by exact distance
+        radius = max_distance * (1 + 1e-9)
+        if idxs is None:
+            pairs = tree.query_pairs(radius, output_type="ndarray")
+            pairs = pairs.reshape(-1, 2)
+            i, j = pairs[:, 0], pairs[:, 1]
+            if symmetric:
+                i, j = np.concatenate([i, j]), np.concatenate([j, i])
+        else:
+            idxs = np.asarray(idxs, dtype=int)
+            found = tree.query_ball_point(coords[idxs], radius)
+            i = np.repeat(idxs, [len(d) for d in found])
+            j = np.concatenate([np.zeros(0, dtype=int)] + [np.asarray(d, dtype=int) for d in found])
+            keep = j != i if symmetric else j > i
+            i, j = i[keep], j[keep]
+        order = np.lexsort((j, i))
+        i, j = i[order], j[order]
+
+        X = coords[:, 0]
+        Y = coords[:, 1]
+        D = abs((Y[i] + 1j * X[i]) - (Y[j] + 1j * X[j]))
+        A = np.arctan2(Y[j] - Y[i], X[j] - X[i])
+        keep = (D > 0) & (D <= max_distance)
+        return i[keep], j[keep], D[keep], A[keep]
+
+    def get_nearest_distances(self, k=8):
+        """Get distance of each vector to its closest following vector
+        Equals the row minimum of `get_distance_matrix` when zeros are ignored,
+        i.e. only vectors j > i are considered (inf if there is none).
+        Neighbours are queried from a KD-tree; the number of queried
+        neighbours `k` is doubled for vectors which are not yet resolved.
+        """
+        coords = self.coords
+        n = len(coords)
+        out = np.full(n, np.inf)
+        if n < 2:
+            return out
+        tree = self.tree
+        Z = coords[:, 1] + 1j * coords[:, 0]
+        todo = np.arange(n - 1)
+        while len(todo) > 0:
+            k = min(k, n)
+            _, idxs = tree.query(coords[todo], k=k)
+            idxs = idxs.reshape(len(todo), k)
+            D = abs(Z[todo, None] - Z[idxs])
+            valid = (idxs > todo[:, None]) & (D > 0)
+            D[~valid] = np.inf
+            resolved = valid.any(axis=1) | (k == n)
+            out[todo[resolved]] = D[resolved].min(axis=1)
+            todo = todo[~resolved]
+            k *= 2
+        return out